@@ -0,0 +1,453 @@
+'''Benchmarks over synthetic encounters.
+
+    python bench.py validate [count]
+    python bench.py compiled [count]
+    python bench.py repair [count]
+    python bench.py precheck [count]
+    python bench.py lazy [count]
+    python bench.py formats [count]
+    python bench.py format_cache [count]
+    python bench.py json [count]
+    python bench.py mmap [megabytes]
+    python bench.py suite [count] [--save FILE] [--compare FILE]
+
+`suite` is the regression suite: validation, both repairs and whole
+directory runs over generated encounters, with throughput, latency
+percentiles and peak traced memory. `--save` writes the results as
+json, `--compare` prints the change against saved results.
+'''
+import copy
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+
+import jsonschema
+from jsonschema import validate
+from jsonschema.exceptions import ValidationError
+
+from encounter_gen import break_encounter, make_dump, make_encounters, make_mixed_encounters
+from encounter_io import ArrayWriter, dump_array, iter_encounters, read_encounters
+import json_backend
+import schema2
+from lazy_errors import lazy_keywords
+from schema2 import encounter_schema, format_checker, validate_enc
+import fix
+import schema_compiler
+from test_formats import FORMATS, random_value
+
+
+def rate(func, encounters):
+    '''Run `func` over every encounter and return encounters/second.'''
+    start = time.perf_counter()
+    for enc in encounters:
+        func(enc)
+    return len(encounters) / (time.perf_counter() - start)
+
+
+def validate_per_call(enc):
+    # what `validate_enc` used to do: check the schema and build a validator per encounter
+    try:
+        validate(enc, schema=encounter_schema, format_checker=format_checker)
+    except ValidationError as e:
+        return e.message
+
+
+def bench_validate(count):
+    encounters = make_encounters(count)
+    validate_enc(encounters[0])  # warm up, builds the cached validator
+    print(f'validate {count} encounters')
+    print(f'  jsonschema.validate per call : {rate(validate_per_call, encounters):10.1f} enc/s')
+    print(f'  cached validator             : {rate(validate_enc, encounters):10.1f} enc/s')
+
+
+def generic_validate_enc(enc):
+    # `validate_enc` with the generic validator, what it checked with before the compiled one
+    e = jsonschema.exceptions.best_match(schema2.encounter_validator().iter_errors(enc))
+    if e is not None:
+        return schema2.error_text(e)
+
+
+def bench_compiled(count):
+    rng = random.Random(0)
+    valid = make_encounters(count)
+    broken = [break_encounter(enc, rng, 3) for enc in make_encounters(count, seed=count)]
+    generic_validate_enc(valid[0])
+    schema_compiler.validate_enc(valid[0])
+    for name, encounters in [('valid', valid), ('broken', broken)]:
+        print(f'validate {count} {name} encounters')
+        print(f'  generic validator  : {rate(generic_validate_enc, encounters):10.1f} enc/s')
+        print(f'  compiled validator : {rate(schema_compiler.validate_enc, encounters):10.1f} enc/s')
+
+
+def repair_two_passes(enc):
+    # what fix.py used to do, the sorted errors were never used
+    v = fix.DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
+    errors = sorted(v.iter_errors(enc), key=lambda e: e.path)
+    try:
+        v.validate(enc)
+    except ValidationError as e:
+        return e.message
+
+
+def repair_single_pass(enc):
+    v = fix.DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
+    return fix.repair(enc, v)
+
+
+def repairable(func):
+    '''`func` that skips the encounters the repair code crashes on, it still has some holes.'''
+    def repair(enc):
+        try:
+            return func(enc)
+        except Exception:
+            pass
+    return repair
+
+
+def bench_repair(count):
+    rng = random.Random(0)
+    broken = [break_encounter(enc, rng, 3) for enc in make_encounters(count)]
+    print(f'repair {len(broken)} broken encounters')
+    for name, func in [('iter_errors + validate', repair_two_passes), ('single pass repair', repair_single_pass)]:
+        encounters = copy.deepcopy(broken)
+        print(f'  {name:22} : {rate(repairable(func), encounters):10.1f} enc/s')
+
+
+def bench_precheck(count):
+    fix_iter = importlib.import_module('fix-iter')
+    # build the validators before timing
+    fix_iter.repair_validator()
+    fix_iter.repair_precheck()
+    print(f'repair {count} encounters, without -> with the compiled validator precheck')
+    for error_rate in [0.0, 0.1, 0.3, 0.6, 1.0]:
+        encounters = make_mixed_encounters(count, error_rate=error_rate, seed=count)
+        rates = {}
+        for name, module, func in [
+            ('fix-iter.py', fix_iter, fix_iter.repair_encounter), ('fix.py', fix, fix.repair),
+        ]:
+            for precheck in [False, True]:
+                fix_iter.set_precheck(precheck)
+                fix.PRECHECK = precheck
+                rates[name, precheck] = rate(repairable(func), copy.deepcopy(encounters))
+        print(f'  {error_rate:4.0%} broken : ' + ', '.join(
+            f'{name} {rates[name, False]:7.1f} -> {rates[name, True]:7.1f} enc/s'
+            for name in ['fix-iter.py', 'fix.py']
+        ))
+    fix_iter.set_precheck(True)
+    fix.PRECHECK = True
+
+
+def wrap_objects(value, rng, rate):
+    '''Put the dicts under `value` in a list at `rate`, like a parser giving a list of one object.'''
+    items = value.items() if isinstance(value, dict) else enumerate(value) if isinstance(value, list) else ()
+    for key, item in list(items):
+        wrap_objects(item, rng, rate)
+        if isinstance(item, dict) and rng.random() < rate:
+            value[key] = [item]
+    return value
+
+
+def bench_lazy(count):
+    fix_iter = importlib.import_module('fix-iter')
+    fix_iter.repair_validator()
+    rng = random.Random(count)
+    # wrong typed subtrees, the messages have their whole repr
+    broken = [wrap_objects(enc, rng, 0.3) for enc in make_encounters(count, list_size=4)]
+
+    def repair_with(cls):
+        v = cls(schema=encounter_schema, format_checker=format_checker)
+
+        def repair(enc):
+            try:
+                v.validate(enc)
+            except ValidationError as e:
+                return e.validator, e.message
+        return repairable(repair)
+
+    def best_match_with(cls):
+        v = cls(encounter_schema, format_checker=format_checker)
+        return lambda enc: schema2.error_text(jsonschema.exceptions.best_match(v.iter_errors(enc)))
+
+    generic = jsonschema.validators.validator_for(encounter_schema)
+    print(f'{count} encounters with wrong typed subtrees, eager -> lazy messages')
+    for name, eager, lazy in [
+        ('fix-iter.py repair', repair_with(fix_iter.extend_with_default(jsonschema.Draft7Validator)),
+         repair_with(fix_iter.DefaultValidatingDraft7Validator)),
+        ('best_match', best_match_with(generic), best_match_with(lazy_keywords(generic))),
+    ]:
+        before, after = measure(eager, broken), measure(lazy, broken)
+        print(f'  {name:18} : {before["per_s"]:7.1f} -> {after["per_s"]:7.1f} enc/s, '
+              f'peak {before["peak_mb"]:6.2f} -> {after["peak_mb"]:6.2f} MB')
+
+
+def bench_formats(count):
+    rng = random.Random(1)
+    values = [random_value(rng) for _ in range(count * 10)]
+    values = [v for v in values if isinstance(v, str)]
+    print(f'format checks over {len(values)} values')
+    for name, old, new in FORMATS:
+        print(f'  {name:20} : {rate(old, values):12.1f} -> {rate(new, values):12.1f} checks/s')
+
+
+def bench_format_cache(count):
+    # a dump repeats the same values over and over, here every encounter comes back 5 times
+    encounters = make_encounters(count) * 5
+    validate_enc(encounters[0])
+    print(f'validate {len(encounters)} encounters, {count} distinct')
+    rng = random.Random(0)
+    values = [random_value(rng) for _ in range(count)]
+    values = [v for v in values if isinstance(v, str)] * 50
+    checks = {name: (lambda v, name=name: format_checker.conforms(v, name)) for name, _, _ in FORMATS}
+    uncached = {name: rate(check, values) for name, check in checks.items()}
+    uncached_enc = rate(validate_enc, encounters)
+    schema2.enable_format_cache()
+    try:
+        print(f'  no format cache -> format cache : {uncached_enc:12.1f} -> {rate(validate_enc, encounters):12.1f} enc/s')
+        print(f'format checks over {len(values)} values, {len(set(values))} distinct')
+        for name, check in checks.items():
+            print(f'  {name:20} : {uncached[name]:12.1f} -> {rate(check, values):12.1f} checks/s')
+        info = schema2.format_cache_info()
+        print(f'  {info.hits} hits, {info.misses} misses, {info.currsize} cached')
+    finally:
+        schema2.disable_format_cache()
+
+
+def mb_per_s(func, size, repeat=3):
+    '''Best MB/s of `repeat` runs of `func` over `size` bytes.'''
+    best = min(_timed(func) for _ in range(repeat))
+    return size / best / 1e6
+
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def bench_json(count):
+    encounters = [{'file': enc} for enc in make_encounters(count)]
+    text = json.dumps(encounters)
+    size = len(text.encode())
+    print(f'{count} encounters, {size / 1e6:.1f} MB of json')
+    for name in json_backend.available():
+        json_backend.set_backend(name)
+        parsed = json_backend.loads(text)
+        assert parsed == encounters
+        out = io.StringIO()
+        dump_array(encounters, out)
+        assert json.loads(out.getvalue()) == encounters
+        print(f'  {name:8} loads          : {mb_per_s(lambda: json_backend.loads(text), size):8.1f} MB/s')
+        print(f'  {name:8} iter_encounters: {mb_per_s(lambda: list(iter_encounters(io.StringIO(text))), size):8.1f} MB/s')
+        print(f'  {name:8} dump_array     : {mb_per_s(lambda: dump_array(encounters, io.StringIO()), size):8.1f} MB/s'
+              f'{"  (same bytes as json.dump)" if out.getvalue() == text else ""}')
+    json_backend.set_backend()
+
+
+# how a whole file is read, for the peak memory benchmark
+READERS = {
+    'f.read() + json.loads': lambda path: json.loads(open(path).read()),
+    'json.load': lambda path: json.load(open(path)),
+    'f.read() + orjson': lambda path: json_backend.loads(open(path, 'rb').read()),
+    'mmap + orjson': lambda path: read_encounters(path, use_mmap=True),
+    'stream, stdlib': lambda path: read_encounters(path, use_mmap=False),
+}
+
+
+def synthetic_file(megabytes):
+    '''Path of a file of about `megabytes` MB of encounters, made once.'''
+    path = os.path.join(tempfile.gettempdir(), f'bench_encounters_{megabytes}mb.json')
+    if not os.path.exists(path):
+        encounters = [{'file': enc} for enc in make_encounters(200)]
+        with open(path + '.tmp', 'w') as f:
+            writer = ArrayWriter(f)
+            while f.tell() < megabytes * 1e6:
+                for enc in encounters:
+                    writer.write(enc)
+            writer.close()
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def _status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) // 1024
+
+
+def peak_rss(reader, path):
+    # runs in a fresh process, see `bench_mmap`
+    if reader == 'stream, stdlib':
+        json_backend.set_backend('json')
+    start = time.perf_counter()
+    count = sum(1 for _ in READERS[reader](path))
+    print(count, time.perf_counter() - start, _status('VmHWM'))
+
+
+def bench_mmap(megabytes):
+    path = synthetic_file(megabytes)
+    size = os.path.getsize(path) / 1e6
+    print(f'read {size:.0f} MB of encounters, peak RSS of a fresh process (Linux only)')
+    print(f'  baseline: {_status("VmRSS")} MB once bench.py is imported')
+    for reader in READERS:
+        out = subprocess.run(
+            [sys.executable, __file__, '_peak_rss', reader, path], capture_output=True, text=True,
+        )
+        if out.returncode:
+            print(f'  {reader:22} : failed, {out.stderr.strip().splitlines()[-1]}')
+            continue
+        count, seconds, peak = out.stdout.split()
+        print(f'  {reader:22} : peak {int(peak):6d} MB, {size / float(seconds):6.1f} MB/s, {count} encounters')
+
+
+# a case slower than this ratio of the compared results is a regression
+REGRESSION = 1.10
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def measure(func, items):
+    '''Throughput, latency percentiles and peak memory of `func` over `items`.
+
+    The timed run and the memory run are separate, tracemalloc
+    slows everything down. `items` are copied before each run since
+    the repairs change them.
+    '''
+    timed = copy.deepcopy(items)
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for item in timed:
+        t = clock()
+        func(item)
+        latencies.append(clock() - t)
+    total = clock() - start
+    latencies.sort()
+
+    traced = copy.deepcopy(items)
+    tracemalloc.start()
+    for item in traced:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'count': len(items),
+        'per_s': len(items) / total,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p90_ms': percentile(latencies, 90) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'peak_mb': peak / 1e6,
+    }
+
+
+def suite_cases(count, directory):
+    '''The cases of the suite, name -> (function, items).'''
+    fix_iter = importlib.import_module('fix-iter')
+    valid = make_encounters(count)
+    mixed = make_mixed_encounters(count, error_rate=0.3, seed=count)
+    files = make_dump(directory, max(1, count // 10), per_patient=10, seed=count * 2, error_rate=0.3)
+    fix_validator = fix.DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
+    return {
+        'validate_enc valid': (validate_enc, valid),
+        'validate_enc mixed': (validate_enc, mixed),
+        'fix.py repair': (repairable(lambda enc: fix.repair(enc, fix_validator)), mixed),
+        'fix-iter.py repair': (repairable(fix_iter.repair_encounter), mixed),
+        'schema2.py file': (schema2.validate_file, files),
+        'fix-iter.py file': (repairable(lambda path: fix_iter.repair_file(path, True)), files),
+    }
+
+
+def bench_suite(count, save=None, compare=None):
+    directory = tempfile.mkdtemp(prefix='bench_dump_')
+    try:
+        cases = suite_cases(count, directory)
+        validate_enc(cases['validate_enc valid'][1][0])  # builds the cached validator
+        results = {name: measure(func, items) for name, (func, items) in cases.items()}
+    finally:
+        shutil.rmtree(directory)
+
+    previous = None
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['results']
+    print(f'{"case":20} {"items":>6} {"items/s":>10} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"peak MB":>8}')
+    regressions = 0
+    for name, r in results.items():
+        line = (f'{name:20} {r["count"]:6d} {r["per_s"]:10.1f} {r["p50_ms"]:8.3f} '
+                f'{r["p90_ms"]:8.3f} {r["p99_ms"]:8.3f} {r["peak_mb"]:8.2f}')
+        if previous and name in previous:
+            ratio = previous[name]['per_s'] / r['per_s']
+            line += f'  {ratio:5.2f}x the time'
+            if ratio > REGRESSION:
+                regressions += 1
+                line += '  SLOWER'
+        print(line)
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    'jsonschema': jsonschema.__version__,
+                    'json_backend': json_backend.backend,
+                    'count': count,
+                },
+                'results': results,
+            }, f, indent=2)
+        print(f'results saved to {save}')
+    return regressions
+
+
+BENCHMARKS = {
+    'validate': bench_validate,
+    'compiled': bench_compiled,
+    'repair': bench_repair,
+    'precheck': bench_precheck,
+    'lazy': bench_lazy,
+    'formats': bench_formats,
+    'format_cache': bench_format_cache,
+    'json': bench_json,
+    'mmap': bench_mmap,
+    'suite': bench_suite,
+}
+
+# the `count` of the benchmarks that don't default to 200
+DEFAULT_COUNTS = {'mmap': 500}
+
+
+if __name__ == '__main__':
+    # the `$schema` of encounter_schema is unknown to jsonschema, which warns on every call
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    if sys.argv[1:2] == ['_peak_rss']:
+        peak_rss(*sys.argv[2:])
+        sys.exit()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks over synthetic encounters')
+    parser.add_argument('name', nargs='?', default='validate', choices=BENCHMARKS)
+    parser.add_argument('count', nargs='?', type=int,
+                        help='the number of encounters, the megabytes for mmap (200, 500 for mmap)')
+    parser.add_argument('--save', metavar='FILE', help='suite: save the results as json to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='suite: compare with the results saved in FILE')
+    args = parser.parse_args()
+    if args.count is None:
+        args.count = DEFAULT_COUNTS.get(args.name, 200)
+    if args.name == 'suite':
+        # exits with 1 when a case got slower than the compared results
+        sys.exit(1 if bench_suite(args.count, args.save, args.compare) else 0)
+    BENCHMARKS[args.name](args.count)
@@ -0,0 +1,109 @@
+'''Cache per encounter results so identical encounters are done once.
+
+The same document shows up in the files of several patients and again
+in every job run. An encounter is identified by its `doc_hash`, or by a
+hash of its canonical json when it has none, and whatever was computed
+for it (a validation verdict, a repaired document) is kept in a bounded
+LRU cache under that key.
+
+There is one cache per process, `enable_dedup` sets it up.
+'''
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from metrics import count
+
+
+DEDUP_CACHE_SIZE = 10000
+
+# what `ResultCache.get` returns for a key it doesn't have, None is a valid result
+MISSING = object()
+
+
+def content_hash(doc):
+    '''sha256 of the canonical json of `doc`, the same for equal documents.'''
+    text = json.dumps(doc, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def doc_key(doc):
+    '''The key of the encounter document `doc`: its `doc_hash` if it has one.'''
+    if isinstance(doc, dict):
+        doc_hash = doc.get('doc_hash')
+        if isinstance(doc_hash, str) and doc_hash:
+            return 'doc_hash', doc_hash
+    return 'content', content_hash(doc)
+
+
+class ResultCache:
+    '''LRU cache of at most `maxsize` results, with hit/miss counters.
+
+    Safe to share between threads.
+    '''
+
+    def __init__(self, maxsize=DEDUP_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def hit_rate(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+_cache = None
+
+
+def enable_dedup(maxsize=DEDUP_CACHE_SIZE):
+    '''Set up the cache of this process, `maxsize=0` turns it off.'''
+    global _cache
+    _cache = ResultCache(maxsize) if maxsize else None
+
+
+def dedup_cache():
+    '''The `ResultCache` of this process, None when dedup is off.'''
+    return _cache
+
+
+def cached(doc, compute, *scope):
+    '''The result cached for the document `doc`, `compute()` it on a miss.
+
+    `scope` is added to the key, it tells apart different results
+    for the same document. Without a cache `compute()` is simply called
+    and `doc` isn't even hashed. Hits and misses are counted in the
+    metrics as 'dedup_hits' and 'dedup_misses'.
+    '''
+    if _cache is None:
+        return compute()
+    key = (*scope, *doc_key(doc))
+    value = _cache.get(key)
+    if value is MISSING:
+        count('dedup_misses')
+        value = compute()
+        _cache.put(key, value)
+    else:
+        count('dedup_hits')
+    return value
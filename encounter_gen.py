@@ -0,0 +1,146 @@
+'''Synthetic encounters built from `encounter_schema`.
+
+Used by the benchmarks so we don't need a real patient dump
+to measure anything. The generated encounters are valid against
+the schema unless told otherwise.
+'''
+import copy
+import json
+import os
+import random
+
+from schema2 import SCHEMA_DATE_STR, SCHEMA_DOB_STR, encounter_schema
+
+
+# values used for plain strings, roughly what we see in the dumps
+WORDS = [
+    'No data found', 'Hypertension', 'Follow up in 2 weeks', 'Amoxicillin 500mg',
+    'Patient denies chest pain', 'Annual physical', 'Type 2 diabetes mellitus',
+    'Smith', 'John', 'Springfield', 'IL', '62704', 'USA', '(217) 555-0134',
+]
+
+
+def _first_type(schema):
+    type_ = schema.get('type')
+    if isinstance(type_, list):
+        # prefer a non null type so we get some content
+        return next((t for t in type_ if t != 'null'), 'null')
+    return type_
+
+
+def build_value(schema, rng, list_size=2):
+    '''Build a value that is valid against `schema`.
+
+    `list_size` is the number of items of every list, or a
+    `(min, max)` range to pick each list's size from.
+    '''
+    if schema is SCHEMA_DATE_STR or schema is SCHEMA_DOB_STR:
+        return f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/{rng.randint(1930, 2020)}'
+    if schema is encounter_schema['properties']['doc_hash']:
+        # a hash of the source document, unique per document like in the dumps
+        return f'{rng.getrandbits(128):032x}'
+    if 'anyOf' in schema:
+        return build_value(schema['anyOf'][0], rng, list_size)
+    type_ = _first_type(schema)
+    if type_ == 'object':
+        value = {}
+        for key, subschema in schema.get('properties', {}).items():
+            value[key] = build_value(subschema, rng, list_size)
+        if 'additionalProperties' in schema:
+            for key in ('home', 'work'):
+                value[key] = build_value(schema['additionalProperties'], rng, list_size)
+        return value
+    if type_ == 'array':
+        items = schema.get('items', {'type': 'string'})
+        size = rng.randint(*list_size) if isinstance(list_size, tuple) else list_size
+        size = max(size, schema.get('minItems', 0))
+        return [build_value(items, rng, list_size) for _ in range(size)]
+    if type_ == 'string':
+        if schema.get('format') == 'non_empty_string':
+            return f'{rng.randrange(10 ** 6):06d}'
+        return rng.choice(WORDS)
+    if type_ == 'integer':
+        return rng.randrange(10 ** 9)
+    if type_ == 'number':
+        return rng.random() * 100
+    if type_ == 'boolean':
+        return rng.random() < 0.5
+    return None
+
+
+def make_encounter(seed=0, list_size=2):
+    '''Build one valid encounter document (the `file` part of an item).'''
+    rng = random.Random(seed)
+    return build_value(encounter_schema, rng, list_size)
+
+
+def make_encounters(count, seed=0, list_size=2):
+    return [make_encounter(seed + i, list_size) for i in range(count)]
+
+
+# what a broken value gets replaced with, these are the kinds of
+# things the parsers emit when they fail
+BROKEN_VALUES = [None, '', '[]', 'None', 0, [], {}, '(217) 555-0134', ['a', 'b']]
+
+
+def _nodes(value, nodes, depth=1, max_depth=None):
+    if max_depth is not None and depth > max_depth:
+        return nodes
+    if isinstance(value, dict):
+        for key, child in value.items():
+            nodes.append((value, key))
+            _nodes(child, nodes, depth + 1, max_depth)
+    elif isinstance(value, list):
+        for index, child in enumerate(value):
+            nodes.append((value, index))
+            _nodes(child, nodes, depth + 1, max_depth)
+    return nodes
+
+
+def break_encounter(enc, rng, errors=1, max_depth=None):
+    '''Break `errors` random places of `enc` in place.
+
+    A dict key is either removed or gets a wrong typed value,
+    a list item always gets a wrong typed value. Only the places
+    at most `max_depth` levels deep are broken when it is given,
+    the top level keys are at depth 1.
+    '''
+    for _ in range(errors):
+        parent, key = rng.choice(_nodes(enc, [], max_depth=max_depth))
+        if isinstance(parent, dict) and rng.random() < 0.3:
+            del parent[key]
+        else:
+            # a copy, the same list or dict in several places would be repaired through all of them
+            parent[key] = copy.deepcopy(rng.choice(BROKEN_VALUES))
+    return enc
+
+
+def make_mixed_encounters(count, error_rate=0.2, errors=(1, 3), seed=0, list_size=2, max_depth=None):
+    '''`count` encounters, a fraction `error_rate` of them broken.
+
+    A broken encounter has a random number of errors in the `errors`
+    range, see `break_encounter` for `max_depth`.
+    '''
+    rng = random.Random(seed)
+    encounters = make_encounters(count, seed, list_size)
+    for enc in encounters:
+        if rng.random() < error_rate:
+            break_encounter(enc, rng, rng.randint(*errors), max_depth)
+    return encounters
+
+
+def make_dump(path, patients, per_patient=5, seed=0, **options):
+    '''Write a dump of `patients` directories with an `encounters.json` each.
+
+    Laid out like the real dumps, `<path>/<patient_id>/encounters.json`.
+    `options` go to `make_mixed_encounters`. Returns the files written.
+    '''
+    files = []
+    for patient in range(patients):
+        encounters = make_mixed_encounters(per_patient, seed=seed + patient * per_patient, **options)
+        directory = os.path.join(path, f'{seed + patient:08x}')
+        os.makedirs(directory, exist_ok=True)
+        files.append(os.path.join(directory, 'encounters.json'))
+        with open(files[-1], 'w') as f:
+            json.dump([{'file': enc} for enc in encounters], f)
+    return files
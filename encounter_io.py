@@ -0,0 +1,238 @@
+'''Reading and writing of encounter files.'''
+import json
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+
+import json_backend
+
+
+# how much of a file is read at a time by `iter_encounters`
+CHUNK_SIZE = 1 << 16
+# files up to this many characters are parsed whole by a faster json backend
+WHOLE_FILE_SIZE = 1 << 24
+WHITESPACE = ' \t\n\r'
+
+# what `iter_encounters` expects next inside the array
+ITEM_OR_END, ITEM, COMMA_OR_END = range(3)
+
+_decoder = json.JSONDecoder()
+
+
+def iter_encounters(f, chunk_size=CHUNK_SIZE):
+    '''Yield the items of the top level json array of the file `f` one by one.
+
+    Only the item being decoded and about one chunk of the file are
+    in memory at a time, not the whole file. Anything else than an
+    array at the top level is read whole and iterated over, like
+    `json.load` would have been.
+
+    With orjson (see `json_backend`) a file of less than `WHOLE_FILE_SIZE`
+    characters is parsed in one go instead, that is faster than decoding
+    item by item with the stdlib even with the whole file in memory.
+    '''
+    buf, pos, eof = '', 0, False
+    if json_backend.backend != 'json':
+        # `f.read(WHOLE_FILE_SIZE)` would allocate all of it up front even for a small file
+        chunks, size, read_size = [], 0, chunk_size
+        while size < WHOLE_FILE_SIZE:
+            more = f.read(read_size)
+            if not more:
+                value = json_backend.loads(''.join(chunks))
+                if value:
+                    yield from value
+                return
+            chunks.append(more)
+            size += len(more)
+            read_size *= 2
+        buf = ''.join(chunks)
+        pos = _skip(buf, pos)
+    while pos == len(buf) and not eof:
+        more = f.read(chunk_size)
+        eof = not more
+        buf += more
+        pos = _skip(buf, pos)
+    if buf[pos:pos + 1] != '[':
+        value = json_backend.loads(buf + f.read())
+        if value:
+            yield from value
+        return
+
+    pos += 1
+    read_size = chunk_size
+    state = ITEM_OR_END
+    while True:
+        pos = _skip(buf, pos)
+        if pos < len(buf):
+            if buf[pos] == ']' and state != ITEM:
+                _expect_end(f, buf, pos + 1, chunk_size)
+                return
+            if state == COMMA_OR_END:
+                if buf[pos] != ',':
+                    raise json.JSONDecodeError('Expecting \',\' delimiter', buf, pos)
+                pos += 1
+                state = ITEM
+                continue
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            if end is not None:
+                after = _skip(buf, end)
+                # only a `,` or `]` after the value says it is complete,
+                # a number at the end of the buffer might go on in the next chunk
+                if after < len(buf) and buf[after] in ',]' or eof:
+                    yield item
+                    pos = after
+                    read_size = chunk_size
+                    state = COMMA_OR_END
+                    continue
+        elif eof:
+            raise json.JSONDecodeError('Unterminated array', buf, pos)
+        # drop what was already decoded and read more, in bigger
+        # chunks while an item doesn't fit so it isn't quadratic
+        more = f.read(read_size)
+        eof = not more
+        buf = buf[pos:] + more
+        pos = 0
+        read_size *= 2
+
+
+# if `read_encounters` maps the files by default, see `set_mmap`
+_use_mmap = False
+
+
+def set_mmap(enabled):
+    '''Make `read_encounters` memory map the files of this process or not.'''
+    global _use_mmap
+    _use_mmap = bool(enabled)
+
+
+def read_encounters(path, use_mmap=None):
+    '''Yield the encounters of the file at `path`, see `iter_encounters`.
+
+    `use_mmap` is the `set_mmap` setting when None. With it and a backend
+    that parses in place (orjson) the file is memory mapped and parsed
+    straight from the mapping, the text is never copied into a python
+    string. The whole file is parsed at once then, so the items are all
+    in memory, each is dropped as soon as the caller is done with it.
+    Otherwise the file is streamed by `iter_encounters`.
+
+    `--mmap` is not a memory win. The parsed encounters take several
+    times the size of the text and the mapped pages count in the RSS
+    too: `bench.py mmap` peaks at the same RSS as `f.read()` + orjson
+    (941 vs 947 MB for a 100 MB file), while streaming stays at 30 MB.
+    It only parses a bit faster.
+    '''
+    if use_mmap is None:
+        use_mmap = _use_mmap
+    if not (use_mmap and json_backend.buffer_in_place()):
+        with open(path, encoding='utf-8') as f:
+            yield from iter_encounters(f)
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # can't map an empty file, it is an error for json as well
+            value = json_backend.loads('')
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    value = json_backend.buffer_loads(view)
+    if isinstance(value, list):
+        # hand the items over one by one, without keeping them in `value`
+        value.reverse()
+        while value:
+            yield value.pop()
+    elif value:
+        yield from value
+
+
+def _skip(buf, pos):
+    while pos < len(buf) and buf[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _expect_end(f, buf, pos, chunk_size):
+    # only whitespace may follow the array, `json.load` fails on anything else too
+    while True:
+        pos = _skip(buf, pos)
+        if pos < len(buf):
+            raise json.JSONDecodeError('Extra data', buf, pos)
+        buf, pos = f.read(chunk_size), 0
+        if not buf:
+            return
+
+
+class ArrayWriter:
+    '''Write a json array to the file `f` one item at a time.
+
+    The output is byte for byte what `json_backend.dumps` of the
+    list of all the items would write, with the stdlib backend
+    that is what `json.dump` writes.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.dumps = json_backend.dumps
+        self.separator = ', ' if json_backend.backend == 'json' else ','
+        f.write('[')
+
+    def write(self, item):
+        if self.count:
+            self.f.write(self.separator)
+        self.f.write(self.dumps(item))
+        self.count += 1
+
+    def close(self):
+        self.f.write(']')
+
+
+def dump_array(items, f):
+    '''Write the iterable `items` to `f` as a json array, see `ArrayWriter`.'''
+    writer = ArrayWriter(f)
+    for item in items:
+        writer.write(item)
+    writer.close()
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    '''Open `path` for writing, the file only shows up once fully written.
+
+    Everything goes to a temporary file next to `path` which is
+    then renamed over it, so an interrupted run never leaves a
+    half written file behind. Text is written as UTF-8, orjson
+    doesn't escape non-ASCII characters.
+    '''
+    path = os.fspath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def atomic_write_json(path, data):
+    '''Write `data` as json to `path`, see `atomic_open`.'''
+    with atomic_open(path) as f:
+        f.write(json_backend.dumps(data))
+
+
+def atomic_write_text(path, text):
+    '''Write the string `text` to `path`, see `atomic_open`.'''
+    with atomic_open(path) as f:
+        f.write(text)
+
+
+def atomic_write_array(path, items):
+    '''Stream the iterable `items` as a json array to `path`, see `atomic_open`.'''
+    with atomic_open(path) as f:
+        dump_array(items, f)
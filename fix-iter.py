@@ -1,16 +1,28 @@
-import copy
-import json
+import contextvars
+import io
+import os
 import pathlib
 import re
-import sys
+import collections
 import collections.abc
+from functools import lru_cache
 
 
 from jsonschema import Draft7Validator, validate, ValidationError, validators
-import glom
 
 
-from schema2 import encounter_schema, format_checker
+import json_backend
+import json_patch
+from dedup import cached, enable_dedup, hit_rate
+from encounter_io import ArrayWriter, read_encounters, set_mmap
+from lazy_errors import lazy_keywords
+from metrics import count, take
+from output import DirOutput, Progress, open_output
+from profiling import current_profiler, enable_profiling
+from repair_utils import (LEAVE_MISSING, Precheck, RepairContext, RequiredTemplates, assign_path, copy_json,
+                          copy_paths, json_factory, repairing, subschemas)
+from schema2 import count_format_cache, enable_format_cache, encounter_schema, format_checker
+from schema_compiler import compiled_encounter_validator
 
 
 
@@ -33,16 +45,135 @@ TYPES = {
     'null': type(None),
 }
 
+# what `set_defaults` checks the message of a `type` error of `phone` against
+PHONE_MESSAGE = re.compile(r"(\'\(\d+\)\s\d+.*)|(\d+-\d+-\d+.*)|(.* is not of type 'object')")
+
+
+# The repair rules of `set_defaults`, by property and keyword of the
+# error, a None property is any property. A rule is called with the
+# error, the instance with the properties and the properties schema,
+# it repairs what it can and returns whether the error is still reported.
+# An error it leaves as is but still reports goes to `report`.
+
+_reported = contextvars.ContextVar('reported', default=None)
+
+
+def report(error):
+    '''Report `error` from a rule without stopping the repair, see `repair_encounter`.'''
+    reported = _reported.get()
+    if reported is not None:
+        reported.append((error.validator, error.message))
+
+def repair_phone(error, instance, properties):
+    # the change was to create a nested object
+    if PHONE_MESSAGE.search(error.message):
+        instance['phone'] = {'home': error.instance or 'no data found'}
+        count(('fixes', 'phone'))
+    return False
+
+
+def repair_type(error, instance, properties):
+    validator_value = error.validator_value
+    if isinstance(validator_value, list):
+        validator_value = next((value for value in validator_value), 'null')
+    if isinstance(validator_value, dict):
+        validator_value = 'object'
+    default_value = DEFAULT_VALUES.get(validator_value)
+    # if type error.instance is error.validator which will be
+    # eg: `{}` `object`, then only we will update it
+    # the case was particularly for `documentation_of` which had a default value, but the instance had `'[]'`
+    # for some reason
+    if isinstance(error.instance, TYPES.get(error.validator_value)):
+        assign_path(instance, error.path, default_value(error.instance))
+        count(('fixes', 'type'))
+    return False
+
+
+def repair_any_of(error, instance, properties):
+    if error.instance is None:
+        anyOf_type = next(o for o in error.validator_value)['type']
+        func = DEFAULT_VALUES.get(anyOf_type)
+        if properties.get('default') is None:
+            assign_path(instance, error.path, func(error.instance))
+            count(('fixes', 'anyOf'))
+    return True
+
+
+def skip_min_items(error, instance, properties):
+    report(error)
+    return False
+
+
+def skip_required(error, instance, properties):
+    # `required` keys are fixed by `set_required_keys`, which reports no error
+    raise RuntimeError(f'set_required_keys left a required error: {error.message}')
+
+
+REPAIR_RULES = {
+    ('phone', 'type'): repair_phone,
+    (None, 'type'): repair_type,
+    (None, 'anyOf'): repair_any_of,
+    (None, 'minItems'): skip_min_items,
+    (None, 'required'): skip_required,
+}
+
+
+PropertiesRules = collections.namedtuple('PropertiesRules', 'properties defaults copies dispatch')
+
+
+class RepairRules:
+    '''The `rules` (like `REPAIR_RULES`) compiled for each `properties` of a schema.
+
+    Every `properties` gets its schema defaults, with a function making
+    a fresh copy of each (see `json_factory`), and a dict of the rule
+    of each `(property, keyword)`, so an error finds its rule with
+    one lookup however many rules there are.
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.keywords = {keyword for property, keyword in rules}
+        # id of the properties -> `PropertiesRules`, they keep the properties alive
+        self._compiled = {}
+
+    def compile(self, schema):
+        '''Compile the rules of every `properties` in `schema` up front.'''
+        for subschema in subschemas(schema):
+            if isinstance(subschema.get('properties'), dict):
+                self.for_properties(subschema['properties'])
+
+    def for_properties(self, properties):
+        compiled = self._compiled.get(id(properties))
+        if compiled is None:
+            defaults = {
+                property: subschema['default'] for property, subschema in properties.items()
+                if isinstance(subschema, dict) and 'default' in subschema
+            }
+            dispatch = {}
+            for property in properties:
+                for keyword in self.keywords:
+                    rule = self.rules.get((property, keyword)) or self.rules.get((None, keyword))
+                    if rule is not None:
+                        dispatch[property, keyword] = rule
+            copies = {property: json_factory(default) for property, default in defaults.items()}
+            compiled = self._compiled[id(properties)] = PropertiesRules(properties, defaults, copies, dispatch)
+        return compiled
+
+
+repair_rules = RepairRules(REPAIR_RULES)
+required_templates = RequiredTemplates(DEFAULT_VALUES)
+
+
 def extend_with_default(validator_class):
     validate_properties = validator_class.VALIDATORS["properties"]
     validate_required = validator_class.VALIDATORS["required"]
 
     def set_defaults(validator, properties, instance, schema):
+        rules = repair_rules.for_properties(properties)
         # if we can provide default value in our schema, we can probably use this
         # mainly for `reason_for_referral` atm
-        for property, subschema in properties.items(): # shouldn't hit
-            if "default" in subschema:
-                instance.setdefault(property, subschema["default"])
+        for property, default in rules.defaults.items(): # shouldn't hit
+            instance.setdefault(property, default)
 
         for error in validate_properties(
             validator,
@@ -50,75 +181,16 @@ def extend_with_default(validator_class):
             instance,
             schema,
         ):
-            for property, subschema in properties.items():
-                # if "default" in subschema and error.path[0] == property:
-                # really trying to target `documentation_of` which i shouldn't do actually
-                if "default" in subschema and error.path[0] == property and len(error.path) <= 2:
-                    if property == 'description':
-                        breakpoint()
-                    instance[property] = copy.deepcopy(subschema["default"])
-            # if error.validator in ['required', 'minItems',]:
-            if error.validator in ['minItems',]:
-                print('*err', error.message)
-                continue # skip since we already do fix `required` keys in below function
-
-            if error.validator == 'required':
-                breakpoint() # shoudln't hit here
-                continue
-
-            if error.validator == 'type':
-                # handle particular case for `phone`,
-                # because the change was to create a nested object
-                if error.path[0] == 'phone':
-                    if re.search(r'(\'\(\d+\)\s\d+.*)|(\d+-\d+-\d+.*)', error.message):
-                        instance['phone'] = {'home': error.instance or 'no data found'}
-                    elif error.message == "None is not of type 'object'":
-                        instance['phone'] = {'home': error.instance or 'no data found'}
-                    elif re.search(r".* is not of type 'object'", error.message):
-                        instance['phone'] = {'home': error.instance or 'no data found'}
-                    continue
-                else:
-                    validator_value = error.validator_value
-                    if isinstance(validator_value, list):
-                        validator_value = next((value for value in validator_value), 'null')
-                    if isinstance(validator_value, dict):
-                        validator_value = 'object'
-                    elif error.validator in ['minItems']:
-                        validator_value = 'misc'
-                    
-                    try:
-                        default_value =  DEFAULT_VALUES.get(validator_value)
-                        # if type error.instance is error.validator which will be
-                        # eg: `{}` `object`, then only we will update it
-                        # the case was particularly for `documentation_of` which had a default value, but the instance had `'[]'`
-                        # for some reason 
-                        if isinstance(error.instance, TYPES.get(error.validator_value)):
-                            glom.assign(instance, '.'.join(str(x) for x in error.path), default_value(error.instance))
-                    except TypeError as e:
-                        raise
-
-                continue
-            elif error.validator == 'anyOf':
-                try:
-                    if error.instance is None:
-                        anyOf_type = next(o for o in error.validator_value)['type']
-                        func = DEFAULT_VALUES.get(anyOf_type)
-                        if schema['properties'].get('default') is None:
-                            glom.assign(instance, '.'.join(str(x) for x in error.path), func(error.instance))
-                # except TypeError as e:
-                except Exception as e:
-                    breakpoint()
-                    e
-                    raise
-
-            # else:
-            #     ...
-            #     # breakpoint()
-
-            yield error
+            property = error.path[0]
+            # really trying to target `documentation_of` which i shouldn't do actually
+            if property in rules.defaults and len(error.path) <= 2:
+                instance[property] = rules.copies[property]()
+                count(('fixes', 'default'))
+            rule = rules.dispatch.get((property, error.validator))
+            if rule is None or rule(error, instance, properties):
+                yield error
 
     def set_min_items(validator, min_length, instance, schema):
-        breakpoint()
         if 'default' in schema:
             # we will extend and see if we get any maxItems error
             instance.extend(schema['default'])
@@ -128,51 +200,25 @@ def extend_with_default(validator_class):
         type_ = aP['type']
         func =  DEFAULT_VALUES.get(type_)
         for key, value in instance.items():
-            instance[key] = func(value)
+            new = func(value)
+            # a valid value comes back the same, the document isn't touched then
+            if type(new) is not type(value) or new != value:
+                instance[key] = new
+                count(('fixes', 'additionalProperties'))
 
     def set_required_keys(validator, keys, instance, schema):
-        for error in validate_required(validator, keys, instance, schema):
-            for key in keys:
-                if key in instance:
-                    continue
-                try:
-                    type_ = schema['properties'][key]['type']
-                except KeyError as e:
-                    raise
-                if isinstance(type_, list):
-                    type_ = next((value for value in type_), 'null')
-                if isinstance(type_, dict):
-                    type_ = 'object'
-                try:
-                    default_value =  DEFAULT_VALUES.get(type_)
-                except TypeError as e:
-                    raise
-
-                # `ehr_id` and `enc_type` can't be None according to schema
-                if key in ["ehr_id", "enc_type"]:
-                    instance[key] = "NA"
-                elif key == "patient_id":
-                    # trying to fix as much as we could.
-                    # hack to get the patient id from the filename
-                    # don't do this...usually
-                    # breakpoint()
-                    import sys
-                    frame = sys._getframe(11) # why 11 ? i don't know :), i manually checked and found it was 10, could have been 11, 12 or who knows even 20
-                    # we will get the file name like
-                    # `PosixPath('test_dump/06a34afd0d292aec2fdd92334f8a160e114ccbe72c17121addea38ac6df01ab3/encounters.json')`
-                    # from this we can just get the stem
-                    # which will be the patient_id. Need to make sure, otherwise patient_id will be wrong, 
-                    # and incorrect data is *worser* than no data
-                    fname = frame.f_globals.get('file_')
-                    patient_id = fname.parent.stem
-                    instance[key] = patient_id
-                    # print(f'{fname=}')
-                else:
-                    try:
-                        instance[key] = default_value(None)
-                    except TypeError as e:
-                        raise
-            # yield error # commenting this is required, but need to figure out why
+        # what `validate_required` checks, without making its errors
+        if not validator.is_type(instance, "object"):
+            return
+        template = required_templates.for_schema(schema)
+        # every missing key at once, in the order of `required`
+        missing = {key: make() for key, make in template.items() if key not in instance}
+        if not missing:
+            return
+        filled = {key: value for key, value in missing.items() if value is not LEAVE_MISSING}
+        instance.update(filled)
+        count(('fixes', 'required'), len(filled))
+        # yield error # commenting this is required, but need to figure out why
 
 
 
@@ -191,34 +237,270 @@ def extend_with_default(validator_class):
     )
 
 
-DefaultValidatingDraft7Validator = extend_with_default(Draft7Validator)
+DefaultValidatingDraft7Validator = extend_with_default(lazy_keywords(Draft7Validator))
+
+
+@lru_cache(maxsize=None)
+def repair_validator():
+    '''Return the repairing validator, built once per process.'''
+    cls = DefaultValidatingDraft7Validator
+    repair_rules.compile(encounter_schema)
+    required_templates.compile(encounter_schema)
+    profiler = current_profiler()
+    if profiler is not None:
+        cls = profiler.extend(cls, encounter_schema)
+    return cls(schema=encounter_schema, format_checker=format_checker)
+
+
+_precheck = True
+
+
+def set_precheck(enabled):
+    '''Check the encounters with the compiled validator before repairing them, see `repair_encounter`.'''
+    global _precheck
+    _precheck = enabled
+
+
+@lru_cache(maxsize=None)
+def _schema_precheck():
+    return Precheck(encounter_schema, compiled_encounter_validator())
+
+
+def repair_precheck():
+    '''The `Precheck` of the repair, None when it is off or the schema doesn't allow it.'''
+    if _precheck and _schema_precheck().enabled:
+        return _schema_precheck()
+
+
+def init_worker(format_cache_size=0, dedup_size=0, mmap=False, precheck=True):
+    enable_format_cache(format_cache_size)
+    enable_dedup(dedup_size)
+    set_mmap(mmap)
+    set_precheck(precheck)
+    repair_validator()
+    repair_precheck()
+
+
+def uses_patient_id(doc):
+    '''If repairing `doc` fills in the patient id, it then depends on the file it is in.'''
+    try:
+        return 'patient_id' not in doc['demographics']['parser']
+    except (KeyError, TypeError):
+        return True
+
+
+def repair_encounter(doc):
+    '''Repair `doc`.
+
+    Returns the repaired document and the keyword and message of each
+    error that couldn't be fixed: the ones the rules `report` and the
+    one the repair stopped at, empty when it was all fixed.
+
+    With the precheck (`set_precheck`) `doc` is first checked by the
+    compiled validator, which is several times faster than the repair
+    walk. A document with nothing to repair is returned as is, the
+    others are repaired copy-on-write: only the parts the repair
+    changes are copied, see `repair_utils.copy_paths`, and `doc`
+    itself is left as it is. Without it `doc` is repaired in place.
+    '''
+    check = repair_precheck()
+    if check is not None:
+        paths, subtrees = check.paths(doc)
+        if not paths and not subtrees:
+            return doc, ()
+        doc = copy_paths(doc, paths, subtrees)
+    errors = []
+    token = _reported.set(errors)
+    try:
+        repair_validator().validate(doc)
+    except ValidationError as e:
+        errors.append((e.validator, e.message))
+    finally:
+        _reported.reset(token)
+    return doc, tuple(errors)
+
+
+def repair_stream(context, encounters, out_f=None, ops=None):
+    '''Repair every encounter of the iterable `encounters`, write them to `out_f` if given.
+
+    Returns the messages of the errors that couldn't be fixed. An
+    encounter already repaired elsewhere gets the repaired document
+    from the dedup cache, its fixes are only counted in the metrics
+    the first time. When `ops` is a list the JSON Patch operations of
+    the repairs are added to it, see json_patch.py.
+    '''
+    messages = []
+    seen = 0
+    # encounters are read, repaired and written out one at a time
+    with repairing(context):
+        writer = ArrayWriter(out_f) if out_f is not None else None
+        for enc in encounters:
+            seen += 1
+            doc = enc['file']
+            # without the precheck the repair changes `doc` in place
+            if ops is not None:
+                before = doc if repair_precheck() is not None else copy_json(doc)
+            scope = ('repair', context.patient_id) if uses_patient_id(doc) else ('repair',)
+            enc['file'], errors = cached(doc, lambda: repair_encounter(doc), *scope)
+            if ops is not None:
+                ops += json_patch.diff(before, enc['file'], f'/{seen - 1}/file')
+            for keyword, message in errors:
+                count(('errors', keyword))
+                messages.append(message)
+            if writer is not None:
+                writer.write(enc)
+        if writer is not None:
+            writer.close()
+    count('files')
+    count('encounters', seen)
+    return messages
+
+
+Repaired = collections.namedtuple('Repaired', 'path text messages counts')
+
+
+@lru_cache(maxsize=None)
+def _dir_output(out_dir):
+    # one per process, it knows the directories it made
+    return DirOutput(out_dir)
+
+
+def repair_file(file_, write, patch=False, out_dir=None, iter_dir=None):
+    '''Repair every encounter of `file_`.
+
+    Returns a `Repaired` with the repaired file as text (None when
+    not `write`), what `repair_stream` returns and the metrics counted
+    meanwhile. With `patch` the text is the JSON Patch of the repairs
+    instead, None when nothing changed. The text is written out by
+    the caller, so a single process does the writing of an archive.
+
+    With `out_dir` the repaired file is streamed into that directory
+    instead, under its path relative to `iter_dir`, and the text is
+    None: only one encounter at a time is in memory, not the whole
+    text of the file, a copy of it pickled to the parent and another
+    waiting there to be written.
+    '''
+    context = RepairContext(file_, options={'write': write, 'patch': patch})
+    ops = [] if write and patch else None
+    count('bytes_read', os.path.getsize(file_))
+    if write and not patch and out_dir is not None:
+        with _dir_output(out_dir).open(os.path.relpath(file_, iter_dir)) as out:
+            messages = repair_stream(context, read_encounters(file_), out)
+        text = None
+    elif write and not patch:
+        out = io.StringIO()
+        messages = repair_stream(context, read_encounters(file_), out)
+        text = out.getvalue()
+    else:
+        messages = repair_stream(context, read_encounters(file_), None, ops)
+        text = json_backend.dumps(ops) if ops else None
+    count_format_cache()
+    return Repaired(file_, text, messages, take())
 
 
 if __name__ == '__main__':
+    import argparse
+    import functools
+    import multiprocessing
+
+    import metrics
+
     BASE_PATH = pathlib.Path(__file__).parent
 
-    iter_dir = BASE_PATH / sys.argv[1]
-    out_dir = BASE_PATH / sys.argv[2]
-    out_dir.mkdir(exist_ok=True)
-
-    for file_ in iter_dir.glob('**/*.json'):
-        with open(file_) as f:
-            encounter_data = json.load(f)
-        fix_data = []
-        for enc in encounter_data:
-            try:
-                v = DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
-                v.validate(enc['file'])
-            except ValidationError as e:
-                # breakpoint()
-                print(e.message)
-            fix_data.append(enc)
-        if sys.argv[3]:   
-            parts = list(file_.parts)
-            parts[-3] = out_dir.stem
-            new_path = pathlib.Path(*parts)
-            new_path.parent.mkdir(exist_ok=True)
-            with open(new_path, 'w') as f:
-                json.dump(fix_data, f)
-            print('.', end='', flush=True)
-    print()
+    parser = argparse.ArgumentParser(description='Repair every json file under iter_dir into out_dir')
+    parser.add_argument('iter_dir')
+    parser.add_argument('out_dir', help='a directory, or a .tar(.gz|.bz2|.xz), .zip or .jsonl '
+                                        'file to pack all the repaired files into')
+    parser.add_argument('write', help='write the repaired files, pass an empty string for a dry run')
+    parser.add_argument('--patch', action='store_true',
+                        help='write a JSON Patch of the repairs (<file>.patch) for each file changed instead '
+                             'of the repaired files, json_patch.py applies them')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes repairing files in parallel')
+    parser.add_argument('--progress', type=float, default=1.0, metavar='SECONDS',
+                        help='print the progress at most every SECONDS')
+    parser.add_argument('--format-cache', type=int, default=0, metavar='SIZE',
+                        help='cache up to SIZE format checker verdicts per process, 0 for no cache')
+    parser.add_argument('--dedup', type=int, default=0, metavar='SIZE',
+                        help='cache up to SIZE repaired encounters per process by doc_hash, '
+                             'so identical encounters are repaired once, 0 for no cache')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory map the files and parse them whole without a copy of the text, '
+                             'needs orjson. Faster, but no less memory than reading them whole, '
+                             'see encounter_io.read_encounters')
+    parser.add_argument('--no-precheck', action='store_true',
+                        help='repair every encounter in place, without checking it with the compiled '
+                             'validator first')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='time every keyword, format checker and assign_path, print where the time '
+                             'went and write a collapsed stack file for flamegraphs to FILE. Runs in one process')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.profile:
+        profiler = enable_profiling()
+        profiler.wrap_formats(format_checker)
+        # the repairing validators look it up in this module
+        assign_path = profiler.wrap(assign_path)
+        args.workers = 1
+
+    iter_dir = BASE_PATH / args.iter_dir
+    output = open_output(BASE_PATH / args.out_dir) if args.write else None
+
+    files = sorted(iter_dir.glob('**/*.json'))
+    if isinstance(output, DirOutput) and not args.patch:
+        # the workers stream the repaired files into the directory themselves
+        repair = functools.partial(repair_file, write=args.write, out_dir=output.root, iter_dir=iter_dir)
+    else:
+        # an archive or the patches are written by this process only,
+        # the text of each file comes back from the worker whole
+        repair = functools.partial(repair_file, write=args.write, patch=args.patch)
+    if args.workers > 1:
+        # each worker builds its validator once and repairs whole files,
+        # the results come back in whatever order the files finish
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                                    initargs=(args.format_cache, args.dedup, args.mmap, not args.no_precheck))
+        results = pool.imap_unordered(repair, files, chunksize=8)
+    else:
+        init_worker(args.format_cache, args.dedup, args.mmap, not args.no_precheck)
+        pool = None
+        results = map(repair, files)
+
+    stats = metrics.Metrics()
+    reporter = metrics.reporter_from_args(stats, args)
+    progress = Progress(len(files), args.progress)
+    try:
+        for repaired in results:
+            stats.merge(repaired.counts)
+            for message in repaired.messages:
+                progress.print(message)
+            if output is not None and repaired.text is not None:
+                name = str(repaired.path.relative_to(iter_dir))
+                output.write(name + json_patch.PATCH_SUFFIX if args.patch else name, repaired.text)
+            progress.update()
+            stats.gauge('files_pending', len(files) - progress.done)
+    except BaseException:
+        if output is not None:
+            output.abort()
+        raise
+    else:
+        if output is not None:
+            output.close()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        progress.close()
+        stats.merge(take())
+        reporter.stop()
+    if args.dedup:
+        dedup_hits, dedup_misses = stats.counters['dedup_hits'], stats.counters['dedup_misses']
+        print(f'Dedup: {dedup_hits} hits, {dedup_misses} misses, '
+              f'{hit_rate(dedup_hits, dedup_misses):.1%} hit rate')
+    if args.format_cache:
+        cache_hits, cache_misses = stats.counters['format_cache_hits'], stats.counters['format_cache_misses']
+        print(f'Format cache: {cache_hits} hits, {cache_misses} misses, '
+              f'{hit_rate(cache_hits, cache_misses):.1%} hit rate')
+    if args.profile:
+        print(profiler.report())
+        profiler.write_collapsed(args.profile)
+        print(f'Collapsed stacks written to {args.profile}')
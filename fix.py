@@ -1,12 +1,16 @@
 import ast
 import collections
-import json
+import contextvars
 import pathlib
+from functools import lru_cache
 from jsonschema import Draft7Validator, validators
-from jsonschema.exceptions import ValidationError
-import glom
 
+from encounter_io import ArrayWriter, iter_encounters
+from lazy_errors import lazy_keywords
+from metrics import count
+from repair_utils import LEAVE_MISSING, Precheck, RepairContext, RequiredTemplates, assign_path, copy_paths, repairing
 from schema2 import encounter_schema, format_checker
+from schema_compiler import compiled_encounter_validator
 
 
 def fix_object(x):
@@ -19,6 +23,20 @@ def fix_object(x):
 
 DEBUG = False
 
+# one change `repair` made to a document, `path` is where in the
+# document, `validator` the keyword of the error that was fixed
+# ('default' for a schema default) and `value` the new value
+Fix = collections.namedtuple('Fix', 'path validator message value')
+
+# the fixes of the document `repair` is working on, the validators
+# below append `(instance, relative path, validator, message, value)` to it
+_fixes = contextvars.ContextVar('fixes', default=None)
+
+def record_fix(instance, path, validator, message, value):
+    fixes = _fixes.get()
+    if fixes is not None:
+        fixes.append((instance, tuple(path), validator, message, value))
+
 DEFAULT_VALUES = {
     'string': lambda x: ''.join(x) if isinstance(x, collections.abc.Container) else str(x),
     'array': lambda x: [x],
@@ -30,6 +48,9 @@ DEFAULT_VALUES = {
     'misc': str,
 }
 
+# how the missing `required` keys of each subschema are filled in
+required_templates = RequiredTemplates(DEFAULT_VALUES)
+
 def extend_with_default(validator_class):
     validate_properties = validator_class.VALIDATORS["properties"]
     validate_type = validator_class.VALIDATORS["type"]
@@ -46,7 +67,10 @@ def extend_with_default(validator_class):
         # mainly for `reason_for_referral` atm
         for property, subschema in properties.items():
             if "default" in subschema:
+                missing = property not in instance
                 instance.setdefault(property, subschema["default"])
+                if missing:
+                    record_fix(instance, [property], 'default', None, subschema["default"])
 
         for error in validate_properties(
             validator,
@@ -67,9 +91,11 @@ def extend_with_default(validator_class):
             
             try:
                 default_value =  DEFAULT_VALUES.get(validator_value)
-                glom.assign(instance, '.'.join(str(x) for x in error.path), default_value(error.instance))
+                value = default_value(error.instance)
+                assign_path(instance, error.path, value)
             except TypeError as e:
                 raise
+            record_fix(instance, error.path, error.validator, error.message, value)
             yield error
 
 
@@ -96,41 +122,17 @@ def extend_with_default(validator_class):
             print(f"{instance=}")
             print(f"{schema=}")
 
-        for error in validate_required(validator, keys, instance, schema):
-            key = error.message.partition(" ")[0].strip("'")
-            type_ = schema['properties'][key]['type']
-            if isinstance(type_, list):
-                type_ = next((value for value in type_), 'null')
-            if isinstance(type_, dict):
-                type_ = 'object'
-            try:
-                default_value =  DEFAULT_VALUES.get(type_)
-            except TypeError as e:
-                # breakpoint()
-                raise
-
-            if "'date' is a required property" in error.message:
-                breakpoint()
-
-            # `ehr_id` and `enc_type` can't be None according to schema
-            if key in ["ehr_id", "enc_type"]:
-                instance[key] = "NA"
-            elif key == "patient_id":
-                # trying to fix as much as we could.
-                # hack to get the patient id from the filename
-                # don't do this...usually
-                import sys
-                frame = sys._getframe(10) # why 10 ? i don't know :), i manually checked and found it was 10, could have been 11, 12 or who knows even 20
-                # we will get the file name like
-                # `PosixPath('test_dump/06a34afd0d292aec2fdd92334f8a160e114ccbe72c17121addea38ac6df01ab3/encounters.json')`
-                # from this we can just get the stem
-                # which will be the patient_id. Need to make sure, otherwise patient_id will be wrong, 
-                # and incorrect data is *worser* than no data
-                fname = frame.f_globals.get('file')
-                patient_id = fname.parent.stem
-                instance[key] = patient_id
-            else:
-                instance[key] = default_value(None)
+        template = required_templates.for_schema(schema)
+        # `validate_required` reports the missing keys in the order of `required`
+        missing = [key for key in template if key not in instance] if isinstance(instance, dict) else []
+        for key, error in zip(missing, validate_required(validator, keys, instance, schema)):
+            value = template[key]()
+            if value is LEAVE_MISSING:
+                yield error
+                continue
+            instance[key] = value
+            # `error.validator` is only set once the error is yielded
+            record_fix(instance, [key], 'required', error.message, instance[key])
             yield error
 
 
@@ -144,7 +146,118 @@ def extend_with_default(validator_class):
     )
 
 
-DefaultValidatingDraft7Validator = extend_with_default(Draft7Validator)
+DefaultValidatingDraft7Validator = extend_with_default(lazy_keywords(Draft7Validator))
+required_templates.compile(encounter_schema)
+
+
+# check the documents with the compiled validator before repairing them, see `repair`
+PRECHECK = True
+
+@lru_cache(maxsize=None)
+def _schema_precheck():
+    return Precheck(encounter_schema, compiled_encounter_validator())
+
+def repair_precheck():
+    '''The `Precheck` of `repair`, None when it is off or the schema doesn't allow it.'''
+    if PRECHECK and _schema_precheck().enabled:
+        return _schema_precheck()
+
+
+def repair(document, validator=None, context=None):
+    '''Repair `document`, in one walk when it has nothing to fix.
+
+    When the walk fixed something a second walk goes on up to the first
+    error, the same as the `iter_errors` + `validate` run of before.
+
+    With `PRECHECK` a document with nothing to repair is returned as
+    is and the others are repaired copy-on-write, `document` is left
+    as it is. Without it `document` is repaired in place.
+
+    `context` is the `RepairContext` of the document, it tells
+    the validators where the document comes from.
+
+    Returns the repaired document and the list of `Fix`es applied
+    to it, in the order they were made. A fix that a later fix
+    replaced together with its parent is not in the list.
+    '''
+    if validator is None:
+        validator = DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
+    if context is None:
+        context = RepairContext()
+    check = repair_precheck()
+    if check is not None:
+        # like fix-iter.py's `repair_encounter`, skip what has nothing to
+        # repair and leave `document` as it is
+        paths, subtrees = check.paths(document)
+        if not paths and not subtrees:
+            return document, []
+        document = copy_paths(document, paths, subtrees)
+    fixes = []
+    token = _fixes.set(fixes)
+    try:
+        # the validators fix the document while it is being walked
+        with repairing(context):
+            for error in validator.iter_errors(document):
+                pass
+            if fixes:
+                # a fix can bring up errors the walk had already passed, like a
+                # `default` with a missing required key. The old `iter_errors` +
+                # `validate` run walked again up to the first error, so do we
+                for error in validator.iter_errors(document):
+                    break
+    finally:
+        _fixes.reset(token)
+    if not fixes:
+        return document, []
+    paths = node_paths(document)
+    # an error bubbles up through the `properties` of every parent and
+    # each of them applies the fix again, keep one fix with the last value
+    applied = {}
+    for instance, path, validator, message, value in fixes:
+        if id(instance) in paths:
+            path = paths[id(instance)] + path
+            applied[path, validator, message] = Fix(path, validator, message, value)
+    return document, list(applied.values())
+
+
+def repair_stream(f, out_f, context=None):
+    '''Repair the encounters read from `f` one at a time and write them to `out_f`.
+
+    Returns the `Fix`es of all the encounters.
+    '''
+    fixes = []
+    writer = ArrayWriter(out_f)
+    v = DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
+    seen = 0
+    for enc in iter_encounters(f):
+        seen += 1
+        # one pass, repairs the encounter and tells what it fixed
+        enc['file'], enc_fixes = repair(enc['file'], v, context)
+        fixes += enc_fixes
+        writer.write(enc)
+    writer.close()
+    count('files')
+    count('encounters', seen)
+    for fix in fixes:
+        count(('fixes', fix.validator))
+    return fixes
+
+
+def node_paths(document, path=(), paths=None):
+    '''Map the id of every dict and list in `document` to its path.'''
+    if paths is None:
+        paths = {}
+    paths[id(document)] = path
+    if isinstance(document, dict):
+        items = document.items()
+    elif isinstance(document, list):
+        items = enumerate(document)
+    else:
+        return paths
+    for key, value in items:
+        if isinstance(value, (dict, list)):
+            node_paths(value, path + (key,), paths)
+    return paths
 
 
 if __name__ == '__main__':
@@ -160,26 +273,13 @@ if __name__ == '__main__':
         # print(file)
         if '13e145f6628cdaab1204cfa0a5306ebe98c9bfb6b2b87c18da2418be291d11b9' in str(file):
             breakpoint()
-        with open(file) as f:
-            fixed_data = []
-            data = json.load(f)
-            for enc in data:
-                v = DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
-                errors = sorted(v.iter_errors(enc['file']), key=lambda e: e.path)
-                try:
-                    # DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker).validate(enc["file"])
-                    v.validate(enc['file'])
-                except ValidationError as e:
-                    # breakpoint()
-                    print(e.message, e.path)
-                    # pass
-                fixed_data.append(enc)
         parts = list(file.parts)
         parts[-3] = 'new_dump'
         new_path = pathlib.Path(*parts)
         new_path.parent.mkdir(exist_ok=True)
-        with open(new_path, 'w') as f:
-            # json.dump(fixed_data, f, default=str)
-            json.dump(fixed_data, f)
+        # encounters are read, fixed and written out one at a time
+        with open(file, encoding='utf-8') as f, open(new_path, 'w', encoding='utf-8') as out:
+            for fix in repair_stream(f, out, RepairContext(file)):
+                print(fix.message, fix.path)
         print('.', end='', flush=True)
     print()
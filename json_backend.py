@@ -0,0 +1,103 @@
+'''The json library encounters are parsed and serialised with.
+
+orjson is used when it is installed, it parses and dumps our encounters
+several times faster than the stdlib `json`. Set the environment
+variable `ENCOUNTER_JSON=json` (or call `set_backend('json')`) to use
+the stdlib `json` anyway.
+
+Parsing gives the same python objects with both. orjson refuses a few
+things the stdlib accepts (NaN / Infinity, integers over 64 bits), on
+those `loads` falls back to the stdlib so nothing that used to load
+fails now.
+
+Dumping is NOT byte for byte the same. orjson writes:
+
+    - no spaces after `,` and `:`  ({"a":1,"b":[1,2]} instead of {"a": 1, "b": [1, 2]})
+    - non ascii characters as utf-8 instead of \\uXXXX escapes
+    - floats in exponent notation without the `+` (1e16 instead of 1e+16)
+    - NaN and Infinity as null, the stdlib writes them as is, which isn't json
+
+The documents are equal once parsed, but use the stdlib backend when
+the output has to be byte identical to what `json.dump` wrote before.
+'''
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKENDS = ['orjson', 'json']
+
+
+def available():
+    '''The names of the backends that can be used here, best first.'''
+    return [name for name in BACKENDS if name != 'orjson' or orjson is not None]
+
+
+def _json_loads(text):
+    return json.loads(text)
+
+
+def _json_dumps(value):
+    return json.dumps(value)
+
+
+def _orjson_loads(text):
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        # NaN, big integers... or really broken, the stdlib tells
+        return json.loads(text)
+
+
+def _orjson_dumps(value):
+    try:
+        return orjson.dumps(value).decode()
+    except TypeError:
+        # what orjson can't serialise, like non string keys
+        return json.dumps(value)
+
+
+def buffer_loads(buf):
+    '''Parse the utf-8 json in the bytes like `buf` (bytes, memoryview, mmap...).
+
+    Only orjson parses it in place, the stdlib first makes a copy
+    of the text. See `buffer_in_place`.
+    '''
+    if backend == 'orjson':
+        try:
+            return orjson.loads(buf)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(bytes(buf))
+
+
+def buffer_in_place():
+    '''If `buffer_loads` parses without copying the text.'''
+    return backend == 'orjson'
+
+
+_FUNCTIONS = {
+    'json': (_json_loads, _json_dumps),
+    'orjson': (_orjson_loads, _orjson_dumps),
+}
+
+backend = None
+loads = dumps = None
+
+
+def set_backend(name=None):
+    '''Use the backend `name`, the best one available when None.'''
+    global backend, loads, dumps
+    if name is None:
+        name = available()[0]
+    if name not in available():
+        raise ValueError(f'Unknown or not installed json backend {name!r}, have {available()}')
+    backend = name
+    loads, dumps = _FUNCTIONS[name]
+
+
+set_backend(os.environ.get('ENCOUNTER_JSON') or None)
@@ -0,0 +1,185 @@
+'''JSON Patch (RFC 6902) of the repairs, and applying them later.
+
+`fix-iter.py --patch` writes, for each file it changed, the patch
+turning the file read into the repaired one instead of the whole
+repaired file. The paths of the operations point into the array of
+the file, like `/3/file/demographics/parser/patient_id` for the
+fourth encounter. Unchanged files get no patch, so what is written
+grows with the number of repairs, not with the size of the dump.
+
+`diff` only writes `add`, `remove` and `replace`, that is all
+`apply` knows. A list whose length changed is replaced as a whole.
+
+Applying the patches of a run gives the files fix-iter.py would have
+written:
+
+    python json_patch.py PATCHES ITER_DIR OUT_DIR [--all]
+
+PATCHES is the output of `fix-iter.py --patch`: a directory, a tar or
+zip archive or a .jsonl file. OUT_DIR is like the one of fix-iter.py.
+With `--all` the unchanged files are written too.
+'''
+import io
+import os
+import pathlib
+import tarfile
+import zipfile
+
+import json_backend
+from encounter_io import dump_array, read_encounters
+
+
+# the name of the patch of a file is the name of the file with this after it
+PATCH_SUFFIX = '.patch'
+
+
+def escape(key):
+    '''`key` as a JSON Pointer path segment.'''
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def unescape(segment):
+    return segment.replace('~1', '/').replace('~0', '~')
+
+
+def diff(old, new, path=''):
+    '''The operations turning `old` into `new`, with `path` in front of their paths.'''
+    ops = []
+    _diff(old, new, path, ops)
+    return ops
+
+
+def _diff(old, new, path, ops):
+    if old is new:
+        # shared by a copy-on-write repair, unchanged
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'remove', 'path': f'{path}/{escape(key)}'})
+        for key, value in new.items():
+            if key in old:
+                _diff(old[key], value, f'{path}/{escape(key)}', ops)
+            else:
+                ops.append({'op': 'add', 'path': f'{path}/{escape(key)}', 'value': value})
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            _diff(old_item, new_item, f'{path}/{index}', ops)
+    # 1 == 1.0 == True, but they aren't the same json
+    elif type(old) is not type(new) or old != new:
+        ops.append({'op': 'replace', 'path': path, 'value': new})
+
+
+def _parent(doc, path):
+    # the container the last segment of `path` is in, and that segment
+    *parents, last = [unescape(segment) for segment in path.split('/')[1:]]
+    for segment in parents:
+        doc = doc[int(segment)] if isinstance(doc, list) else doc[segment]
+    if isinstance(doc, list):
+        last = len(doc) if last == '-' else int(last)
+    return doc, last
+
+
+def apply(doc, ops):
+    '''Apply the operations `ops` to `doc`, in place as far as possible.
+
+    Returns the patched document, a new one when the root is replaced.
+    '''
+    for op in ops:
+        name, path = op['op'], op['path']
+        if path == '':
+            if name not in ('add', 'replace'):
+                raise ValueError(f'Can\'t {name} the root of a document')
+            doc = op['value']
+            continue
+        parent, key = _parent(doc, path)
+        if name == 'add':
+            if isinstance(parent, list):
+                parent.insert(key, op['value'])
+            else:
+                parent[key] = op['value']
+        elif name == 'replace':
+            missing = key >= len(parent) if isinstance(parent, list) else key not in parent
+            if missing:
+                raise KeyError(f'Nothing to replace at {path}')
+            parent[key] = op['value']
+        elif name == 'remove':
+            del parent[key]
+        else:
+            raise ValueError(f'Unsupported JSON Patch operation {name!r}')
+    return doc
+
+
+def read_patches(path):
+    '''Yield `(file name, operations)` of the patches written to `path` by `fix-iter.py --patch`.'''
+    name = os.fspath(path)
+    if name.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json_backend.loads(line)
+                    # `output.JsonlOutput` puts the text of a file under 'encounters'
+                    yield record['path'], record['encounters']
+    elif name.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.namelist():
+                yield member, json_backend.loads(archive.read(member))
+    elif os.path.isfile(path):
+        with tarfile.open(path) as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, json_backend.loads(archive.extractfile(member).read())
+    else:
+        root = pathlib.Path(path)
+        for patch_path in sorted(root.glob(f'**/*{PATCH_SUFFIX}')):
+            yield str(patch_path.relative_to(root)), json_backend.loads(patch_path.read_bytes())
+
+
+def patched_text(file_, ops):
+    '''The encounters of `file_` with the operations `ops` applied, as the text fix-iter.py writes.'''
+    encounters = apply(list(read_encounters(file_)), ops)
+    out = io.StringIO()
+    dump_array(encounters, out)
+    return out.getvalue()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from output import Progress, open_output
+
+    parser = argparse.ArgumentParser(
+        description='Apply the patches of fix-iter.py --patch to the files they were made from')
+    parser.add_argument('patches', help='the output of fix-iter.py --patch')
+    parser.add_argument('iter_dir', help='the files the patches were made from')
+    parser.add_argument('out_dir', help='a directory, or a .tar(.gz|.bz2|.xz), .zip or .jsonl '
+                                        'file to pack the patched files into')
+    parser.add_argument('--all', action='store_true',
+                        help='write the files without a patch too, as fix-iter.py does')
+    args = parser.parse_args()
+
+    iter_dir = pathlib.Path(args.iter_dir)
+    patches = {}
+    for name, ops in read_patches(args.patches):
+        if not name.endswith(PATCH_SUFFIX):
+            parser.error(f'{name} is not a patch')
+        patches[name[:-len(PATCH_SUFFIX)]] = ops
+    if args.all:
+        names = [str(p.relative_to(iter_dir)) for p in sorted(iter_dir.glob('**/*.json'))]
+    else:
+        names = sorted(patches)
+
+    output = open_output(args.out_dir)
+    progress = Progress(len(names))
+    try:
+        for name in names:
+            output.write(name, patched_text(iter_dir / name, patches.get(name, [])))
+            progress.update()
+    except BaseException:
+        output.abort()
+        raise
+    else:
+        output.close()
+    finally:
+        progress.close()
+    print(f'{len(patches)} files patched')
@@ -0,0 +1,129 @@
+'''Validation errors whose message is only made when it is read.
+
+The jsonschema keyword functions format the message of an error as they
+build it, `repr` of the instance included. On a broken encounter that is
+the `repr` of every subtree of the wrong type, and of every branch of an
+`anyOf` that didn't match, most of which nobody ever looks at: the
+repair reads the message of a few errors only, the precheck and
+`best_match` none but the one they pick.
+
+`lazy_keywords` extends a validator class with keyword functions giving
+the same errors, but as `LazyError`s keeping what the message is made
+of. The message is made, once, the first time it is read, so what is
+logged or reported doesn't change.
+'''
+from jsonschema import validators
+from jsonschema.exceptions import ValidationError
+
+
+class LazyError(ValidationError):
+    '''A `ValidationError` with the message `make_message(*args)`, made on first read.'''
+
+    def __init__(self, make_message, *args, **kwargs):
+        super().__init__('', **kwargs)
+        self._make_message = make_message
+        self._message_args = args
+
+    @property
+    def message(self):
+        if self._make_message is not None:
+            self._message = self._make_message(*self._message_args)
+            self._make_message = self._message_args = None
+        return self._message
+
+    @message.setter
+    def message(self, value):
+        self._message = value
+        self._make_message = self._message_args = None
+
+    def __reduce__(self):
+        # copies and pickles carry the message, not what it is made of
+        return ValidationError, (self.message,), self.__dict__.copy()
+
+
+# The messages of the jsonschema keyword functions
+
+def type_message(instance, types):
+    reprs = ", ".join(repr(type) for type in types)
+    return f"{instance!r} is not of type {reprs}"
+
+
+def required_message(property):
+    return f"{property!r} is a required property"
+
+
+def min_items_message(instance, min_items):
+    message = "should be non-empty" if min_items == 1 else "is too short"
+    return f"{instance!r} {message}"
+
+
+def format_message(instance, format):
+    return f"{instance!r} is not a {format!r}"
+
+
+def any_of_message(instance):
+    return f"{instance!r} is not valid under any of the given schemas"
+
+
+# The keyword functions, the same as the ones of jsonschema but for the errors
+
+def type(validator, types, instance, schema):
+    types = types if isinstance(types, list) else [types]
+    if not any(validator.is_type(instance, type) for type in types):
+        yield LazyError(type_message, instance, types)
+
+
+def required(validator, required, instance, schema):
+    if not validator.is_type(instance, "object"):
+        return
+    for property in required:
+        if property not in instance:
+            yield LazyError(required_message, property)
+
+
+def min_items(validator, min_items, instance, schema):
+    if validator.is_type(instance, "array") and len(instance) < min_items:
+        yield LazyError(min_items_message, instance, min_items)
+
+
+def format(validator, format, instance, schema):
+    # `FormatChecker.check` without the `FormatError` and its message
+    checker = validator.format_checker
+    if checker is None or format not in checker.checkers:
+        return
+    func, raises = checker.checkers[format]
+    result, cause = None, None
+    try:
+        result = func(instance)
+    except raises as e:
+        cause = e
+    if not result:
+        yield LazyError(format_message, instance, format, cause=cause)
+
+
+def any_of(validator, any_of, instance, schema):
+    all_errors = []
+    for index, subschema in enumerate(any_of):
+        errors = list(validator.descend(instance, subschema, schema_path=index))
+        if not errors:
+            break
+        all_errors.extend(errors)
+    else:
+        yield LazyError(any_of_message, instance, context=all_errors)
+
+
+LAZY_KEYWORDS = {
+    'type': type,
+    'required': required,
+    'minItems': min_items,
+    'format': format,
+    'anyOf': any_of,
+}
+
+
+def lazy_keywords(validator_class):
+    '''`validator_class` with the keyword functions of `LAZY_KEYWORDS` for the ones it has.'''
+    return validators.extend(
+        validator_class,
+        {keyword: func for keyword, func in LAZY_KEYWORDS.items() if keyword in validator_class.VALIDATORS},
+    )
@@ -0,0 +1,118 @@
+'''Remember the validation results of files between runs.
+
+The manifest is a small SQLite database keyed by file path. For every
+file it keeps the size, mtime and sha256 of the content it was validated
+with, and the results. A file whose size and mtime didn't change is not
+even read again; when only the mtime changed the content hash decides.
+
+The manifest also keeps a fingerprint of the schema and the format
+checkers, when that changes every stored result is thrown away.
+'''
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+
+import jsonschema
+
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    '''The sha256 hex digest of the content of `path`.'''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def function_source(func):
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        code = func.__code__
+        return repr((code.co_code, code.co_consts, code.co_names))
+
+
+def schema_fingerprint(schema, format_checker, *extra):
+    '''A hash of everything a verdict depends on besides the file itself.
+
+    That is the `schema`, the code of the checkers of `format_checker`,
+    the jsonschema version and whatever is in `extra`.
+    '''
+    h = hashlib.sha256()
+    h.update(json.dumps(schema, sort_keys=True, default=repr).encode())
+    for name, (func, raises) in sorted(format_checker.checkers.items()):
+        h.update(name.encode())
+        h.update(function_source(func).encode())
+    h.update(jsonschema.__version__.encode())
+    for value in extra:
+        h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+class Manifest:
+    '''The results of the files validated by the previous runs.
+
+    `kind` tells apart results of different kinds (the logs or the
+    full report) for the same file. Results are stored as json, so
+    tuples come back as lists.
+    '''
+
+    def __init__(self, path, fingerprint):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT, kind TEXT, size INTEGER, mtime_ns INTEGER, hash TEXT, results TEXT,
+                PRIMARY KEY (path, kind)
+            );
+        ''')
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            # the schema or the checkers changed, nothing stored is valid anymore
+            self.db.execute('DELETE FROM files')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+            self.db.commit()
+        self.hits = self.misses = 0
+
+    def lookup(self, path, kind):
+        '''Return `(results, entry)` for `path`.
+
+        `results` are the stored results when the file didn't change,
+        else None. `entry` is what `store` needs to record new results,
+        for a file to validate its hash may still be None: it is left to
+        whoever validates the file, see `schema2.with_digest`, so a new
+        dump isn't read once here before the workers even start.
+        '''
+        st = os.stat(path)
+        entry = [st.st_size, st.st_mtime_ns, None]
+        row = self.db.execute(
+            'SELECT size, mtime_ns, hash, results FROM files WHERE path = ? AND kind = ?', (path, kind)
+        ).fetchone()
+        if row is not None and row[0] == st.st_size:
+            if row[1] != st.st_mtime_ns:
+                # touched, maybe not changed
+                entry[2] = file_hash(path)
+                if entry[2] == row[2]:
+                    self.db.execute(
+                        'UPDATE files SET mtime_ns = ? WHERE path = ? AND kind = ?', (st.st_mtime_ns, path, kind)
+                    )
+            if row[1] == st.st_mtime_ns or entry[2] == row[2]:
+                self.hits += 1
+                return json.loads(row[3]), entry
+        self.misses += 1
+        return None, entry
+
+    def store(self, path, kind, entry, results):
+        self.db.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            (path, kind, *entry, json.dumps(results)),
+        )
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,186 @@
+'''Counters of a run, as a json snapshot file and for Prometheus.
+
+The code doing the work counts with `count`, in the process and thread
+it runs in, which is just a dict update. Whoever hands out the work
+collects the counts with `take` (the worker functions send them back
+with their results) and `Metrics.merge`s them. So the hot loops don't
+take a lock or talk to another process.
+
+A count is a name ('files', 'encounters', 'bytes_read', 'bytes_written',
+'dedup_hits', ...) or a `(name, label)` tuple, like `('errors', 'type')`
+or `('fixes', 'required')`. Bytes are the characters of the json text,
+the same as bytes for the ascii the dumps are made of.
+
+`Reporter` writes `Metrics.snapshot()` to a json file every few seconds
+and serves `Metrics.prometheus()` on http://127.0.0.1:PORT/metrics.
+'''
+import collections
+import http.server
+import threading
+import time
+
+from encounter_io import atomic_write_json
+
+
+PREFIX = 'migrate'
+# the counts that also get a per second rate
+RATES = ['files', 'encounters', 'bytes_read', 'bytes_written']
+
+_local = threading.local()
+
+
+def _counts():
+    try:
+        return _local.counts
+    except AttributeError:
+        _local.counts = collections.Counter()
+        return _local.counts
+
+
+def count(key, n=1):
+    '''Count `n` more `key` in this thread.'''
+    _counts()[key] += n
+
+
+def take():
+    '''The counts of this thread since the last `take`.'''
+    counts = _counts()
+    _local.counts = collections.Counter()
+    return counts
+
+
+class Metrics:
+    '''The counts of a whole run and the current value of some gauges.'''
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def merge(self, counts):
+        with self._lock:
+            self.counters.update(counts)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        '''The counters, rates and gauges as a json-able dict.'''
+        with self._lock:
+            counters = dict(self.counters)
+        elapsed = time.monotonic() - self.started
+        snapshot = {'elapsed_s': round(elapsed, 3)}
+        for key, value in sorted(counters.items(), key=str):
+            if isinstance(key, tuple):
+                snapshot.setdefault(key[0], {})[str(key[1])] = value
+            else:
+                snapshot[key] = value
+        for name in RATES:
+            snapshot[f'{name}_per_s'] = round(counters.get(name, 0) / elapsed, 3) if elapsed else 0.0
+        snapshot['gauges'] = dict(self.gauges)
+        return snapshot
+
+    def prometheus(self):
+        '''The metrics in the Prometheus text format.'''
+        with self._lock:
+            counters = dict(self.counters)
+        lines = []
+        by_name = collections.defaultdict(list)
+        for key, value in counters.items():
+            if isinstance(key, tuple):
+                by_name[key[0]].append((key[1], value))
+            else:
+                by_name[key].append((None, value))
+        for name, values in sorted(by_name.items()):
+            metric = f'{PREFIX}_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            label = 'keyword' if name == 'errors' else 'rule' if name == 'fixes' else 'label'
+            for label_value, value in sorted(values, key=str):
+                labels = '' if label_value is None else f'{{{label}="{_escape(label_value)}"}}'
+                lines.append(f'{metric}{labels} {value}')
+        elapsed = time.monotonic() - self.started
+        gauges = dict(self.gauges, elapsed_seconds=elapsed)
+        for name in RATES:
+            gauges[f'{name}_per_second'] = counters.get(name, 0) / elapsed if elapsed else 0.0
+        for name, value in sorted(gauges.items()):
+            lines.append(f'# TYPE {PREFIX}_{name} gauge')
+            lines.append(f'{PREFIX}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Reporter:
+    '''Publish `metrics` while a run goes on.
+
+    Every `interval` seconds the snapshot is written to `path`, and
+    with a `port` Prometheus can scrape http://127.0.0.1:port/metrics.
+    Both are optional. `stop` writes the last snapshot.
+    '''
+
+    def __init__(self, metrics, path=None, port=None, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = self._server = None
+        if path:
+            self._thread = threading.Thread(target=self._flush_loop, name='metrics-file', daemon=True)
+            self._thread.start()
+        if port is not None:
+            self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _handler(metrics))
+            threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        if self.path:
+            atomic_write_json(self.path, self.metrics.snapshot())
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _handler(metrics):
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # no line on stderr per scrape
+            pass
+
+    return Handler
+
+
+def add_arguments(parser):
+    '''The command line options of `reporter_from_args`.'''
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help='write a json snapshot of the run metrics to FILE every --metrics-interval')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve the run metrics for Prometheus on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-interval', type=float, default=10.0, metavar='SECONDS')
+
+
+def reporter_from_args(metrics, args):
+    return Reporter(metrics, args.metrics_file, args.metrics_port, args.metrics_interval)
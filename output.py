@@ -0,0 +1,185 @@
+'''Where the repaired files go.
+
+Every output takes whole files, `write(name, text)` with `name` the path
+of the file relative to the output, and `close()` when done:
+
+    DirOutput    a file per name under a directory
+    TarOutput    one tar archive (.tar, .tar.gz, ...)
+    ZipOutput    one zip archive
+    JsonlOutput  one json lines file, a `{"path": name, "encounters": [...]}` line per file
+
+Nothing half written is ever left behind: the files of a `DirOutput`
+and the archives only show up under their name once complete. The
+text written is counted in the metrics as 'bytes_written'.
+
+A `DirOutput` can also be written by several processes at once, each
+streaming its files with `open(name)`, see fix-iter.py.
+'''
+import contextlib
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+import zipfile
+
+from encounter_io import atomic_open
+from metrics import count
+
+
+class DirOutput:
+    '''Write every file under the directory `root`.'''
+
+    def __init__(self, root):
+        self.root = os.fspath(root)
+        # the directories known to exist, so each one is created once
+        self._dirs = set()
+
+    def _path(self, name):
+        path = os.path.join(self.root, name)
+        parent = os.path.dirname(path)
+        if parent not in self._dirs:
+            os.makedirs(parent, exist_ok=True)
+            self._dirs.add(parent)
+        return path
+
+    def write(self, name, text):
+        with atomic_open(self._path(name)) as f:
+            # one write call for the whole file
+            f.write(text)
+        count('bytes_written', len(text))
+
+    @contextlib.contextmanager
+    def open(self, name):
+        '''The file `name` opened for writing a bit at a time, see `atomic_open`.'''
+        path = self._path(name)
+        with atomic_open(path) as f:
+            yield f
+        count('bytes_written', os.path.getsize(path))
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class _ArchiveOutput:
+    '''An archive at `path`, written to a temporary file renamed on `close`.'''
+
+    def __init__(self, path):
+        self._stack = contextlib.ExitStack()
+        self._f = self._stack.enter_context(atomic_open(path, 'wb'))
+
+    def close(self):
+        self._close_archive()
+        self._stack.close()
+
+    def abort(self):
+        '''Drop the archive, nothing shows up at `path`.'''
+        try:
+            # before its file goes, or it tries to finish it when garbage collected
+            self._close_archive()
+        except Exception:
+            pass
+        error = RuntimeError('output aborted')
+        self._stack.__exit__(type(error), error, None)
+
+
+class TarOutput(_ArchiveOutput):
+    '''Pack every file into a tar archive, compressed after the extension of `path`.'''
+
+    def __init__(self, path):
+        super().__init__(path)
+        mode = 'w'
+        for suffix, compression in [('.gz', 'gz'), ('.tgz', 'gz'), ('.bz2', 'bz2'), ('.xz', 'xz')]:
+            if os.fspath(path).endswith(suffix):
+                mode = f'w:{compression}'
+        self._tar = tarfile.open(fileobj=self._f, mode=mode)
+
+    def write(self, name, text):
+        data = text.encode()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self._tar.addfile(info, io.BytesIO(data))
+        count('bytes_written', len(data))
+
+    def _close_archive(self):
+        self._tar.close()
+
+
+class ZipOutput(_ArchiveOutput):
+    '''Pack every file into a deflated zip archive.'''
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._zip = zipfile.ZipFile(self._f, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def write(self, name, text):
+        self._zip.writestr(name, text)
+        count('bytes_written', len(text))
+
+    def _close_archive(self):
+        self._zip.close()
+
+
+class JsonlOutput(_ArchiveOutput):
+    '''Write every file as one json line, the text of a file is a json array.'''
+
+    def write(self, name, text):
+        # the text is json already and json never has a raw newline, it goes in as is
+        line = '{"path": %s, "encounters": %s}\n' % (json.dumps(name), text)
+        self._f.write(line.encode())
+        count('bytes_written', len(text))
+
+    def _close_archive(self):
+        pass
+
+
+def open_output(path):
+    '''The output for `path`, an archive or a json lines file after its extension, else a directory.'''
+    name = os.fspath(path)
+    if name.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+        return TarOutput(path)
+    if name.endswith('.zip'):
+        return ZipOutput(path)
+    if name.endswith('.jsonl'):
+        return JsonlOutput(path)
+    return DirOutput(path)
+
+
+class Progress:
+    '''Print how many of `total` files are done, at most every `interval` seconds.'''
+
+    def __init__(self, total, interval=1.0, stream=None):
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self._last = 0.0
+        # the progress line is on screen, without a newline after it
+        self._shown = False
+
+    def update(self, count=1):
+        self.done += count
+        now = time.monotonic()
+        if now - self._last >= self.interval or self.done == self.total:
+            self._last = now
+            self.stream.write(f'\r{self.done}/{self.total} files')
+            self.stream.flush()
+            self._shown = True
+
+    def print(self, message):
+        '''Print `message` on a line of its own, not after the progress.'''
+        if self._shown:
+            self.stream.write('\n')
+            self._shown = False
+        self.stream.write(f'{message}\n')
+
+    def close(self):
+        if self._shown:
+            self.stream.write('\n')
+            self.stream.flush()
+            self._shown = False
@@ -0,0 +1,251 @@
+'''Validate or repair a dump with an asyncio pipeline.
+
+On a network filesystem opening and reading a file takes longer than
+validating it, and the plain walkers wait on every read. Here the files
+go through three stages:
+
+    read   many files are read at once by a pool of I/O threads
+    work   validation / repair of the text read, in a thread or process pool
+    write  one writer logs the results and writes the repaired files
+
+At most `--concurrency` files are in flight between reading and writing,
+a file has to be written out before the next one can be read, so memory
+stays bounded even when a slow file holds up the others.
+
+    python pipeline.py validate PATH [--concurrency N] [--workers N] [--threads]
+    python pipeline.py repair ITER_DIR OUT_DIR [--dry-run] [...]
+    python pipeline.py fix ITER_DIR OUT_DIR [...]
+
+`validate` writes the same logs as schema2.py, `repair` repairs like
+fix-iter.py and `fix` like fix.py, printing every fix made.
+'''
+import asyncio
+import importlib
+import io
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import schema2
+import fix
+import metrics
+from dedup import hit_rate
+from encounter_io import iter_encounters
+from metrics import count, take
+from output import Progress, open_output
+from repair_utils import RepairContext
+
+fix_iter = importlib.import_module('fix-iter')
+
+
+CONCURRENCY = 16
+
+
+def read_text(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+async def run_pipeline(paths, work, write, concurrency=CONCURRENCY, executor=None, ordered=True, stats=None):
+    '''Run `write(path, work(path, text))` for every path of `paths`.
+
+    The files are read by `concurrency` I/O threads, `work` runs in
+    `executor` (the default executor of the loop when None) and
+    `write` is called in an I/O thread, one file at a time. With
+    `ordered` the files are written in the order of `paths`, else as
+    soon as they are done. An exception of `work` stops the pipeline
+    and is raised. The files in flight and the ones done waiting to be
+    written are kept as gauges of the `metrics.Metrics` `stats`.
+    '''
+    paths = list(paths)
+    loop = asyncio.get_running_loop()
+    io_pool = ThreadPoolExecutor(concurrency, thread_name_prefix='pipeline-io')
+    slots = asyncio.Semaphore(concurrency)
+    done = asyncio.Queue(concurrency)
+    tasks = []
+    in_flight = 0
+
+    def queue_gauges():
+        if stats is not None:
+            stats.gauge('in_flight', in_flight)
+            stats.gauge('done_queue', done.qsize())
+            stats.gauge('write_queue', len(pending))
+
+    async def process(index, path):
+        try:
+            text = await loop.run_in_executor(io_pool, read_text, path)
+            result = await loop.run_in_executor(executor, work, path, text)
+        except Exception as e:
+            result = e
+        await done.put((index, path, result))
+
+    async def feed():
+        nonlocal in_flight
+        for index, path in enumerate(paths):
+            # a slot is given back once the file is written
+            await slots.acquire()
+            in_flight += 1
+            tasks.append(asyncio.create_task(process(index, path)))
+
+    feeder = asyncio.create_task(feed())
+    pending = {}
+    next_index = 0
+    try:
+        for _ in paths:
+            index, path, result = await done.get()
+            if isinstance(result, Exception):
+                raise result
+            if not ordered:
+                await loop.run_in_executor(io_pool, write, path, result)
+                slots.release()
+                in_flight -= 1
+                queue_gauges()
+                continue
+            pending[index] = path, result
+            while next_index in pending:
+                path, result = pending.pop(next_index)
+                await loop.run_in_executor(io_pool, write, path, result)
+                slots.release()
+                in_flight -= 1
+                next_index += 1
+            queue_gauges()
+    finally:
+        feeder.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(feeder, *tasks, return_exceptions=True)
+        io_pool.shutdown()
+
+
+# The work functions return their result and the metrics they counted,
+# in the thread or process they ran in, see `metrics.take`.
+
+def validate_text(path, text):
+    '''The records of `schema2.validate_file` for the content `text` of `path`.'''
+    count('bytes_read', len(text))
+    return schema2.with_counters(schema2.validate_file, path, io.StringIO(text))
+
+
+def repair_text(path, text, write=True):
+    '''Repair the content `text` of `path` like fix-iter.py.
+
+    Returns the repaired text (None when not `write`) and the messages
+    of the errors that couldn't be fixed.
+    '''
+    count('bytes_read', len(text))
+    context = RepairContext(path, options={'write': write})
+    out = io.StringIO() if write else None
+    messages = fix_iter.repair_stream(context, iter_encounters(io.StringIO(text)), out)
+    schema2.count_format_cache()
+    return (out.getvalue() if write else None, messages), take()
+
+
+def fix_text(path, text):
+    '''Repair the content `text` of `path` like fix.py, with the fixes made as text.'''
+    count('bytes_read', len(text))
+    out = io.StringIO()
+    fixes = fix.repair_stream(io.StringIO(text), out, RepairContext(path))
+    schema2.count_format_cache()
+    return (out.getvalue(), [f'{f.message} {f.path}' for f in fixes]), take()
+
+
+def init_worker(command, format_cache_size=0, dedup_size=0):
+    if command == 'validate':
+        schema2.init_worker(format_cache_size, dedup_size)
+    elif command == 'repair':
+        fix_iter.init_worker(format_cache_size, dedup_size)
+    else:
+        schema2.enable_format_cache(format_cache_size)
+
+
+if __name__ == '__main__':
+    import argparse
+    import functools
+
+    parser = argparse.ArgumentParser(description='Validate or repair a dump with an asyncio pipeline')
+    parser.add_argument('command', choices=['validate', 'repair', 'fix'])
+    parser.add_argument('path', help='the dump, ITER_DIR for repair and fix')
+    parser.add_argument('out_dir', nargs='?', help='where repair and fix write the repaired files, '
+                                                   'a directory or a .tar, .zip or .jsonl file')
+    parser.add_argument('--dry-run', action='store_true', help='repair without writing the files')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='number of files in flight, read at the same time')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes (or threads) validating / repairing')
+    parser.add_argument('--threads', action='store_true',
+                        help='validate / repair in threads instead of processes')
+    parser.add_argument('--format-cache', type=int, default=0, metavar='SIZE',
+                        help='cache up to SIZE format checker verdicts per process, 0 for no cache')
+    parser.add_argument('--dedup', type=int, default=0, metavar='SIZE',
+                        help='cache the results of up to SIZE encounters per process by doc_hash')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.command != 'validate' and args.out_dir is None:
+        parser.error(f'{args.command} needs an OUT_DIR')
+
+    initargs = (args.command, args.format_cache, args.dedup)
+    if args.threads:
+        # the threads share the caches of this process
+        init_worker(*initargs)
+        executor = ThreadPoolExecutor(args.workers, thread_name_prefix='pipeline-work')
+    else:
+        executor = ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=initargs)
+
+    stats = metrics.Metrics()
+    output = None
+    if args.command == 'validate':
+        paths = list(schema2.encounter_files(args.path))
+        work = validate_text
+        loggers = schema2.open_logs()
+
+        def write(path, result):
+            records, counts = result
+            stats.merge(counts)
+            print(f'Validating {path}')
+            for log, message in records:
+                loggers[log].error(message)
+                if log == 'error':
+                    print(f'Validation err in {path.split(os.sep)[-2]}')
+    else:
+        output = None if args.dry_run else open_output(args.out_dir)
+        paths = [str(p) for p in sorted(pathlib.Path(args.path).glob('**/*.json'))]
+        if args.command == 'repair':
+            work = functools.partial(repair_text, write=not args.dry_run)
+        else:
+            work = fix_text
+
+        def write(path, result):
+            (text, messages), counts = result
+            stats.merge(counts)
+            for message in messages:
+                progress.print(message)
+            if text is not None:
+                output.write(os.path.relpath(path, args.path), text)
+                # counted in this I/O thread
+                stats.merge(take())
+            progress.update()
+
+    progress = Progress(len(paths))
+    reporter = metrics.reporter_from_args(stats, args)
+    try:
+        # the logs are in file order like schema2.py's, repaired files don't need to be
+        asyncio.run(run_pipeline(
+            paths, work, write, args.concurrency, executor, ordered=args.command == 'validate', stats=stats,
+        ))
+    except BaseException:
+        if output is not None:
+            output.abort()
+        raise
+    else:
+        if output is not None:
+            output.close()
+    finally:
+        executor.shutdown()
+        progress.close()
+        reporter.stop()
+    if args.dedup:
+        hits, misses = stats.counters['dedup_hits'], stats.counters['dedup_misses']
+        print(f'Dedup: {hits} hits, {misses} misses, {hit_rate(hits, misses):.1%} hit rate')
+    if args.format_cache:
+        hits, misses = stats.counters['format_cache_hits'], stats.counters['format_cache_misses']
+        print(f'Format cache: {hits} hits, {misses} misses, {hit_rate(hits, misses):.1%} hit rate')
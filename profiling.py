@@ -0,0 +1,166 @@
+'''Where the validation and repair time goes, per keyword and schema path.
+
+`Profiler.extend` wraps every keyword function of a validator class and
+`Profiler.wrap_formats` every format checker. Each call is timed and
+counted under its keyword and the path of its subschema in the schema,
+like `properties.demographics.properties.parser` shortened to
+`demographics.parser`. A subschema used in several places (like the
+date schemas) is counted under the first of them. A function of our own (say `assign_path`) can be
+timed too with `Profiler.wrap`.
+
+The keyword functions are generators, they are timed while they run,
+not while they wait on their caller, and the time of what they call is
+both in their total time and in the self time of the callee.
+
+At the end `report` gives the ranked tables and `write_collapsed` a
+collapsed stack file (`frame;frame;frame microseconds` per line) that
+flamegraph.pl, speedscope or inferno read.
+
+There is one profiler per process, set with `enable_profiling`.
+'''
+import collections
+import functools
+import time
+
+from jsonschema import validators
+
+
+class Profiler:
+
+    def __init__(self):
+        # label -> [calls, total seconds, self seconds]
+        self.stats = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        # 'label;label;label' -> self seconds
+        self.stacks = collections.defaultdict(float)
+        self._stack = []
+        self._paths = {}
+
+    def _enter(self, label):
+        self._stack.append([label, time.perf_counter(), 0.0])
+
+    def _exit(self):
+        label, start, children = self._stack[-1]
+        elapsed = time.perf_counter() - start
+        stat = self.stats[label]
+        stat[1] += elapsed
+        stat[2] += elapsed - children
+        self.stacks[';'.join(frame[0] for frame in self._stack)] += elapsed - children
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def wrap(self, func, label=None):
+        '''`func` timed under `label`, its name by default.'''
+        label = label or func.__name__
+
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            self.stats[label][0] += 1
+            self._enter(label)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit()
+        return profiled
+
+    def _keyword(self, keyword, func):
+        def profiled(validator, value, instance, schema):
+            label = f'{keyword} {self._paths.get(id(schema), "?")}'
+            self.stats[label][0] += 1
+            self._enter(label)
+            try:
+                errors = func(validator, value, instance, schema)
+                errors = iter(errors) if errors is not None else iter(())
+            finally:
+                self._exit()
+            # the keyword functions are generators, time them each time they run
+            while True:
+                self._enter(label)
+                try:
+                    error = next(errors, None)
+                finally:
+                    self._exit()
+                if error is None:
+                    return
+                yield error
+        return profiled
+
+    def extend(self, validator_class, schema):
+        '''`validator_class` with every keyword function timed, for `schema`.'''
+        self._paths.update(schema_paths(schema))
+        return validators.extend(validator_class, {
+            keyword: self._keyword(keyword, func)
+            for keyword, func in validator_class.VALIDATORS.items()
+        })
+
+    def wrap_formats(self, format_checker):
+        '''Time the checkers of `format_checker`, in place.'''
+        for name, (func, raises) in list(format_checker.checkers.items()):
+            format_checker.checkers[name] = (self.wrap(func, f'format:{name}'), raises)
+
+    def by_keyword(self):
+        '''`(keyword, calls, total, self)` per keyword, the largest self time first.'''
+        keywords = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        for label, (calls, total, self_time) in self.stats.items():
+            stat = keywords[label.split(' ')[0]]
+            stat[0] += calls
+            stat[1] += total
+            stat[2] += self_time
+        return sorted(((k, *v) for k, v in keywords.items()), key=lambda s: -s[3])
+
+    def by_path(self):
+        '''`(label, calls, total, self)` per keyword and path, the largest self time first.'''
+        return sorted(((k, *v) for k, v in self.stats.items()), key=lambda s: -s[3])
+
+    def report(self, top=25):
+        '''The ranked tables as text.'''
+        lines = []
+        for title, rows in [('keyword', self.by_keyword()), ('keyword and schema path', self.by_path())]:
+            lines.append(f'{"by " + title:60} {"calls":>9} {"total s":>9} {"self s":>9}')
+            for label, calls, total, self_time in rows[:top]:
+                lines.append(f'{label[:60]:60} {calls:9d} {total:9.3f} {self_time:9.3f}')
+            lines.append('')
+        return '\n'.join(lines)
+
+    def write_collapsed(self, path):
+        '''Write the stacks with their self time in microseconds, in the collapsed stack format.'''
+        with open(path, 'w') as f:
+            for stack, seconds in sorted(self.stacks.items()):
+                micros = round(seconds * 1e6)
+                if micros:
+                    # spaces separate the count, frames can't have any
+                    f.write(f'{stack.replace(" ", ":")} {micros}\n')
+
+
+def schema_paths(schema, path=(), paths=None):
+    '''Map the id of every subschema of `schema` to its readable path.'''
+    if paths is None:
+        paths = {}
+    if not isinstance(schema, dict):
+        return paths
+    paths.setdefault(id(schema), '.'.join(path).replace('.[]', '[]') or '$')
+    for keyword, value in schema.items():
+        if keyword in ('properties', 'patternProperties') and isinstance(value, dict):
+            for key, subschema in value.items():
+                schema_paths(subschema, path + (key,), paths)
+        elif keyword in ('items', 'additionalProperties', 'not', 'contains'):
+            schema_paths(value, path + (keyword if keyword != 'items' else '[]',), paths)
+        elif keyword in ('anyOf', 'allOf', 'oneOf') and isinstance(value, list):
+            for index, subschema in enumerate(value):
+                schema_paths(subschema, path + (f'{keyword}[{index}]',), paths)
+    return paths
+
+
+_profiler = None
+
+
+def enable_profiling():
+    '''Start profiling this process, return the `Profiler`.'''
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def current_profiler():
+    '''The `Profiler` of this process, None when not profiling.'''
+    return _profiler
@@ -0,0 +1,288 @@
+'''Helpers shared by the repairing validators of fix.py and fix-iter.py.'''
+import contextlib
+import contextvars
+import functools
+import pathlib
+
+
+class RepairContext:
+    '''What the repairing validators know about the document they repair.
+
+    `source_path` is the file the document comes from, `patient_id`
+    defaults to the name of its directory since the dumps are laid
+    out as `<patient_id>/encounters.json`. `options` are the options
+    of the run.
+    '''
+
+    def __init__(self, source_path=None, patient_id=None, options=None):
+        self.source_path = pathlib.Path(source_path) if source_path is not None else None
+        if patient_id is None and self.source_path is not None:
+            patient_id = self.source_path.parent.stem
+        self.patient_id = patient_id
+        self.options = options or {}
+
+    def __repr__(self):
+        return f'RepairContext(source_path={self.source_path!r}, patient_id={self.patient_id!r})'
+
+
+# jsonschema builds a new validator object for every subschema it descends
+# into and only copies its own fields over, so the context can't be stored
+# on the validator. It lives in a context variable instead, which keeps it
+# separate between threads and asyncio tasks.
+_context = contextvars.ContextVar('repair_context', default=RepairContext())
+
+
+def current_context():
+    '''Return the `RepairContext` of the document being repaired.'''
+    return _context.get()
+
+
+@contextlib.contextmanager
+def repairing(context):
+    '''Repair with `context` inside the `with` block.'''
+    token = _context.set(context)
+    try:
+        yield context
+    finally:
+        _context.reset(token)
+
+
+def assign_path(instance, path, value):
+    '''Set the value at `path` inside `instance` to `value`.
+
+    `path` is a sequence of keys and list indices, usually the
+    `error.path` deque of a `ValidationError`. It is used as is, so
+    unlike a dotted string keys may contain dots and nothing needs
+    to be parsed, setting a value is one lookup per path segment.
+    '''
+    *parents, last = path
+    for key in parents:
+        instance = instance[key]
+    instance[last] = value
+
+
+def subschemas(schema):
+    '''Yield every dict in `schema`, `schema` included.'''
+    if isinstance(schema, dict):
+        yield schema
+        values = schema.values()
+    elif isinstance(schema, list):
+        values = schema
+    else:
+        return
+    for value in values:
+        yield from subschemas(value)
+
+
+def copy_json(value):
+    '''A copy of the json value `value`, its dicts and lists are new.'''
+    if isinstance(value, dict):
+        return {key: copy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_json(item) for item in value]
+    return value
+
+
+def _constant(value):
+    return value
+
+
+def json_factory(value):
+    '''A function returning a fresh copy of the json value `value`.
+
+    Strings, numbers and None are shared, dicts and lists are copied
+    without the bookkeeping of `copy.deepcopy`, which is several
+    times slower on the small defaults of the schema.
+    '''
+    if isinstance(value, (dict, list)):
+        return functools.partial(copy_json, value)
+    return functools.partial(_constant, value)
+
+
+# what the function of `patient_id` in a required template returns
+# when there is no patient id, the key is left missing then
+LEAVE_MISSING = object()
+
+
+def _patient_id():
+    # the patient id is the name of the directory of the file
+    # being repaired, see `RepairContext`. Without a file we leave
+    # it missing, incorrect data is *worser* than no data
+    patient_id = current_context().patient_id
+    return LEAVE_MISSING if patient_id is None else patient_id
+
+
+def _raise(error):
+    raise type(error)(*error.args)
+
+
+def required_template(schema, default_values):
+    '''How the missing `required` keys of `schema` are filled in.
+
+    Returns a function per required key, in order, returning the
+    value to fill in. It is worked out once from the type of the key
+    in `schema['properties']` and its function in `default_values`
+    (the `DEFAULT_VALUES` of the repairing module). `ehr_id` and
+    `enc_type` get 'NA' and `patient_id` comes from the
+    `RepairContext`. A key whose value can't be worked out (no type,
+    no default value for its type) raises the same error as before
+    when it has to be filled in.
+    '''
+    template = {}
+    for key in schema.get('required', ()):
+        try:
+            type_ = schema['properties'][key]['type']
+            if isinstance(type_, list):
+                type_ = next((value for value in type_), 'null')
+            if isinstance(type_, dict):
+                type_ = 'object'
+            default_value = default_values.get(type_)
+            # `ehr_id` and `enc_type` can't be None according to schema
+            if key in ['ehr_id', 'enc_type']:
+                make = json_factory('NA')
+            elif key == 'patient_id':
+                make = _patient_id
+            else:
+                make = json_factory(default_value(None))
+        except (KeyError, TypeError) as e:
+            make = functools.partial(_raise, e)
+        template[key] = make
+    return template
+
+
+class RequiredTemplates:
+    '''The `required_template` of every subschema, made once per subschema.'''
+
+    def __init__(self, default_values):
+        self.default_values = default_values
+        # id of the subschema -> (subschema, template), keeps the subschema alive
+        self._templates = {}
+
+    def compile(self, schema):
+        '''Make the templates of every subschema of `schema` with `required` up front.'''
+        for subschema in subschemas(schema):
+            if isinstance(subschema.get('required'), list):
+                self.for_schema(subschema)
+
+    def for_schema(self, schema):
+        entry = self._templates.get(id(schema))
+        if entry is None:
+            entry = self._templates[id(schema)] = schema, required_template(schema, self.default_values)
+        return entry[1]
+
+
+def copy_paths(doc, paths=(), subtrees=()):
+    '''`doc` with the dicts and lists on each of `paths` and `subtrees` copied.
+
+    The dicts and lists from the root down to the end of each path
+    are new, and for `subtrees` everything under the end of the path
+    too. The rest is shared with `doc`, so changing anything on the
+    `paths` or in the `subtrees` leaves `doc` as it is.
+    '''
+    # ids of the containers that are copies already
+    copied = set()
+
+    def fresh(node):
+        if id(node) not in copied:
+            node = node.copy()
+            copied.add(id(node))
+        return node
+
+    if not isinstance(doc, (dict, list)):
+        return doc
+    root = fresh(doc)
+    for path, whole in [(path, False) for path in paths] + [(path, True) for path in subtrees]:
+        parent, last, node = None, None, root
+        for key in path:
+            child = node[key]
+            if not isinstance(child, (dict, list)):
+                # a value, it is replaced in `node`, a copy
+                break
+            node[key] = child = fresh(child)
+            parent, last, node = node, key, child
+        else:
+            if whole:
+                node = copy_json(node)
+                if parent is None:
+                    root = node
+                else:
+                    parent[last] = node
+    return root
+
+
+# The DEFAULT_VALUES of fix.py and fix-iter.py give a valid value of these
+# types back as it is, repairing `additionalProperties` of them changes nothing
+KEEPS_VALID = {'string', 'object', 'null'}
+
+
+def _property_paths(schema, path=(), paths=None):
+    # the path in a document of `schema` and of every subschema under its `properties`
+    if paths is None:
+        paths = {}
+    paths[id(schema)] = path
+    properties = schema.get('properties')
+    if isinstance(properties, dict):
+        for key, subschema in properties.items():
+            if isinstance(subschema, dict):
+                _property_paths(subschema, path + (key,), paths)
+    return paths
+
+
+def optional_defaults(schema):
+    '''`(path of the object, property)` of every property with a default that isn't required.
+
+    The repair fills them in even in a valid document. None when
+    the repair can change a valid document in a way not told by these:
+    a default under `items` or `anyOf`, where its path isn't fixed,
+    or an `additionalProperties` not of a `KEEPS_VALID` type.
+    '''
+    paths = _property_paths(schema)
+    defaults = []
+    for subschema in subschemas(schema):
+        extra = subschema.get('additionalProperties')
+        if isinstance(extra, dict) and extra.get('type') not in KEEPS_VALID:
+            return None
+        properties = subschema.get('properties')
+        if not isinstance(properties, dict):
+            continue
+        for key, property_schema in properties.items():
+            if isinstance(property_schema, dict) and 'default' in property_schema \
+                    and key not in subschema.get('required', ()):
+                if id(subschema) not in paths:
+                    return None
+                defaults.append((paths[id(subschema)], key))
+    return defaults
+
+
+class Precheck:
+    '''Tells what the repair would change in a document, before it walks it.
+
+    `validator` validates `schema` without repairing anything, the
+    compiled validator of schema_compiler is the fastest. A document
+    it finds valid and that has all the optional properties with a
+    default (`optional_defaults`) is left as it is by the repair, the
+    repair walk can be skipped. `enabled` is False when the schema
+    doesn't allow telling, every document has to be repaired then.
+    '''
+
+    def __init__(self, schema, validator):
+        self.validator = validator
+        self.defaults = optional_defaults(schema)
+        self.enabled = self.defaults is not None
+
+    def paths(self, doc):
+        '''`(paths, subtrees)` of `doc` for `copy_paths`, what the repair may change.
+
+        `subtrees` are where the errors are, `paths` the objects missing
+        an optional property with a default. Both are empty when the
+        repair changes nothing.
+        '''
+        subtrees = [error.absolute_path for error in self.validator.iter_errors(doc)]
+        paths = []
+        for path, key in self.defaults:
+            parent = doc
+            for segment in path:
+                parent = parent.get(segment) if isinstance(parent, dict) else None
+            if isinstance(parent, dict) and key not in parent:
+                paths.append(path)
+        return paths, subtrees
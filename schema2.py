@@ -1,14 +1,50 @@
+import contextlib
+import csv
+import json
+import logging
+import os
 import re
-from datetime import datetime
+import threading
+from functools import lru_cache
 
-from jsonschema import FormatChecker, validate
-from jsonschema.exceptions import ValidationError
+from jsonschema import FormatChecker, validators
+from jsonschema.exceptions import best_match
+
+from dedup import cached, enable_dedup, hit_rate
+from encounter_io import iter_encounters, read_encounters, set_mmap
+from lazy_errors import lazy_keywords
+from manifest import file_hash
+from metrics import count, take
+from profiling import current_profiler, enable_profiling
 
 
 
 PLACE_HOLDER = 'No data found'
 NULLS = ['No information', 'no data found', None, 'null', 'None', '']
 
+# The pattern `datetime.strptime` builds for '%m/%d/%Y'
+MM_DD_YYYY = re.compile(r'(1[0-2]|0[1-9]|[1-9])/(3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])/(\d\d\d\d)', re.IGNORECASE)
+DAYS_IN_MONTH = [0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+def is_mm_dd_yyyy(value):
+    '''Check that `datetime.strptime(value, '%m/%d/%Y')` accepts `value`.
+
+    Gives the same verdict for every value without going
+    through `strptime`, which is slow.
+    '''
+    if not isinstance(value, str):
+        return False
+    match = MM_DD_YYYY.fullmatch(value)
+    if match is None:
+        return False
+    month, day, year = match.groups()
+    month, day, year = int(month), int(day), int(year)
+    if year == 0:
+        return False
+    if month == 2 and day == 29:
+        return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    return day <= DAYS_IN_MONTH[month]
+
 # Schema used for the date format
 # It only checks for the 
 SCHEMA_DATE_STR = {
@@ -23,11 +59,7 @@ def normal_date(value):
         return True
     if value == PLACE_HOLDER:
         return True
-    try:
-        datetime.strptime(value, '%m/%d/%Y')
-    except Exception:
-        return False
-    return True
+    return is_mm_dd_yyyy(value)
 
 # Schema used for the date format of DOB
 # It is strictly string and must contain a date
@@ -37,17 +69,15 @@ SCHEMA_DOB_STR = {
 format_checker = FormatChecker()
 @format_checker.checks('normal_dob')
 def normal_dob(value):
-    try:
-        datetime.strptime(value, '%m/%d/%Y')
-    except Exception:
-        return False
-    return True
+    return is_mm_dd_yyyy(value)
 
 # A set of strings that are allowed in phone numbers
 # This will be used to verify the format of phone values
 ACCEPTED_PHONE_STRS = {
     '-', '(', ')', '+',
 }
+# Anything that is not a digit, a whitespace or one of the above
+PHONE_REJECTED = re.compile(r'[^\d\s\-()+]')
 @format_checker.checks('normal_phone_number')
 def normal_phone_number(value):
     if value is None:
@@ -63,9 +93,7 @@ def normal_phone_number(value):
         return False
     if value == '(000)000-0000':
         return False
-    non_number = set(x.strip() for x in re.findall(r'\D', value) if x.strip())
-    non_number = set(x for x in non_number if x not in ACCEPTED_PHONE_STRS)
-    if len(non_number) != 0:
+    if PHONE_REJECTED.search(value):
         return False
     return True
 
@@ -105,13 +133,87 @@ def non_empty_string(value):
     return True
 
 # Format to check that a name is reasonable or not
+NAME = re.compile(r'^[ a-zA-Z\.\-\,\']{1,150}$')
 @format_checker.checks('normal_name')
 def normal_name(value):
     if not non_empty_string(value):
         return False
     if not value.count(" ") < 6:
         return False
-    return bool(re.match(r'^[ a-zA-Z\.\-\,\']{1,150}$', value))
+    return bool(NAME.match(value))
+
+# The same values (DOBs, provider phones, placeholders, 'None' dates)
+# come back millions of times in a dump, their verdicts can be cached
+FORMAT_CACHE_SIZE = 2 ** 16
+_format_cache = None
+# hits and misses of the format cache `count_format_cache` counted already
+_format_cache_counted = (0, 0)
+_format_cache_lock = threading.Lock()
+
+def enable_format_cache(maxsize=FORMAT_CACHE_SIZE):
+    '''Cache the verdicts of the format checkers defined here.
+
+    All the verdicts go in one LRU cache of at most `maxsize` entries,
+    keyed by format name and value, so memory stays capped.
+    `maxsize=0` turns the cache off again. The cache belongs to the
+    process, every worker of a pool has its own.
+    '''
+    global _format_cache
+    disable_format_cache()
+    if not maxsize:
+        return
+    checkers = {
+        name: func for name, (func, raises) in format_checker.checkers.items()
+        if func.__module__ == __name__
+    }
+
+    # typed, a verdict for 1 is not one for '1' or True
+    @lru_cache(maxsize=maxsize, typed=True)
+    def cached(name, value):
+        return checkers[name](value)
+
+    for name, func in checkers.items():
+        format_checker.checkers[name] = (_cached_check(cached, name, func), format_checker.checkers[name][1])
+    _format_cache = cached, checkers
+
+def _cached_check(cached, name, func):
+    def check(value):
+        if isinstance(value, (list, dict)):
+            # can't be a cache key
+            return func(value)
+        return cached(name, value)
+    return check
+
+def disable_format_cache():
+    global _format_cache, _format_cache_counted
+    if _format_cache is not None:
+        cached, checkers = _format_cache
+        for name, func in checkers.items():
+            format_checker.checkers[name] = (func, format_checker.checkers[name][1])
+        _format_cache = None
+        _format_cache_counted = (0, 0)
+
+def format_cache_info():
+    '''Hits, misses, maxsize and current size of the format cache, None when it is off.'''
+    if _format_cache is not None:
+        return _format_cache[0].cache_info()
+
+def count_format_cache():
+    '''Count the hits and misses of the format cache since the last call.
+
+    They go to the metrics as 'format_cache_hits' and 'format_cache_misses',
+    like the dedup ones, so the workers of a pool send them back with
+    their other counts. Called before `take`.
+    '''
+    global _format_cache_counted
+    with _format_cache_lock:
+        info = format_cache_info()
+        if info is None:
+            return
+        hits, misses = _format_cache_counted
+        _format_cache_counted = info.hits, info.misses
+    count('format_cache_hits', info.hits - hits)
+    count('format_cache_misses', info.misses - misses)
 
 encounter_schema = {
     "$schema": "http://json-schema.org/schema#",
@@ -1583,6 +1685,58 @@ encounter_schema = {
     ]
 }
 
+@lru_cache(maxsize=None)
+def encounter_validator():
+    '''Return the validator for the encounter schema.
+
+    The schema is checked against its metaschema and the
+    validator is built only once per process, `jsonschema.validate`
+    would redo both of these for every single encounter.
+    '''
+    cls = validators.validator_for(encounter_schema)
+    cls.check_schema(encounter_schema)
+    # only the message of the error picked by `best_match` is made
+    cls = lazy_keywords(cls)
+    profiler = current_profiler()
+    if profiler is not None:
+        cls = profiler.extend(cls, encounter_schema)
+    return cls(encounter_schema, format_checker=format_checker)
+
+@lru_cache(maxsize=None)
+def checking_validator():
+    '''Return the validator `first_error` and `report_file` check with.
+
+    The compiled validator of schema_compiler, it gives the same
+    errors as `encounter_validator`. When profiling it is
+    `encounter_validator`, the profiler times its keyword functions.
+    '''
+    if current_profiler() is not None:
+        return encounter_validator()
+    # schema_compiler imports this module. Compiled here, with the format
+    # checker of this module: run as a script it isn't the `schema2` one
+    from schema_compiler import compile_schema
+    return compile_schema(encounter_schema, format_checker=format_checker)
+
+def init_worker(format_cache_size=0, dedup_size=0, mmap=False):
+    '''Set up a validating process: the caches, how files are read and the validator.'''
+    enable_format_cache(format_cache_size)
+    enable_dedup(dedup_size)
+    set_mmap(mmap)
+    checking_validator()
+
+def with_counters(check, filepath, *args):
+    '''`check(filepath, *args)` and the metrics counted meanwhile, see `metrics.take`.'''
+    records = check(filepath, *args)
+    count_format_cache()
+    return records, take()
+
+def with_digest(check, filepath, *args):
+    '''`with_counters` and the sha256 of the file for the manifest, see `manifest.file_hash`.'''
+    # hashed before the file is validated, a change made
+    # meanwhile shows up as a new mtime on the next run
+    digest = file_hash(filepath)
+    return with_counters(check, filepath, *args), digest
+
 def validate_enc(enc):
     '''Validate a python data structure against the
     enocounter schema.
@@ -1592,62 +1746,277 @@ def validate_enc(enc):
     A string return means there is and error and the
     string contains the error mesage.
     '''
+    error = first_error(enc)
+    if error is not None:
+        return error[1]
+
+def first_error(enc):
+    '''The keyword and the text of the error `validate_enc` reports, None when valid.'''
+    # same error `jsonschema.validate` would raise
+    e = best_match(checking_validator().iter_errors(enc))
+    if e is not None:
+        return e.validator, error_text(e)
+
+def error_text(e):
+    '''The message `validate_enc` reports for the `ValidationError` `e`.'''
+    msg = e.message
+    if e.absolute_path:
+        path = ' -> '.join([str(x) for x in e.absolute_path])
+    else:
+        path = 'root'
+    err_text = f"{msg} in {path}"
+    return err_text
+
+def encounter_files(path):
+    '''Yield every `encounters.json` under `path`.
+
+    The walk is sorted so two runs over the same dump report
+    in the same order and their logs can be diffed.
+    '''
+    for root, pat_id, fnames in os.walk(path):
+        pat_id.sort()
+        for file in sorted(fnames):
+            filepath = os.path.join(root, file)
+            if filepath.endswith('encounters.json'):
+                yield filepath
+
+def _encounters(filepath, f=None):
+    # read from the file object `f` when the content of `filepath` was already read
+    if f is not None:
+        return contextlib.closing(iter_encounters(f))
+    count('bytes_read', os.path.getsize(filepath))
+    return contextlib.closing(read_encounters(filepath))
+
+def validate_file(filepath, f=None):
+    '''Validate every encounter of one `encounters.json` file.
+
+    Returns a list of `(log, message)` records, `log` is the name
+    of the log file the message goes to: 'error', 'key_error' or 'empty'.
+    An empty list means the file is valid. Like before we stop
+    at the first invalid encounter of a file. The encounters are
+    read from `f` instead of `filepath` when it is given.
+    '''
+    patient = filepath.split(os.sep)[-2]
+    count('files')
+    # counted once per file, not in the loop
+    seen = 0
     try:
-        validate(enc, schema=encounter_schema, format_checker=format_checker)
-    except ValidationError as e:
-        msg = e.message
-        if e.absolute_path:
-            path = ' -> '.join([str(x) for x in e.absolute_path])
+        with _encounters(filepath, f) as encounters:
+            # encounters are read one at a time, not the whole file
+            for item in encounters:
+                seen += 1
+                try:
+                    value = item['file']
+                except (KeyError, TypeError) as e:
+                    return [('key_error', f"{patient} - {e}")]
+                error = cached(value, lambda: first_error(value), 'validate')
+                if error:
+                    keyword, err = error
+                    count(('errors', keyword))
+                    encdate = value.get('encdate')
+                    return [('error', f"{patient}  - {encdate} -  {err}")]
+    finally:
+        count('encounters', seen)
+    if not seen:
+        return [('empty', patient)]
+    return []
+
+# where the records of `validate_file` are logged: log, logger name, file
+LOGS = [
+    ('error', 'error', 'error.log'),
+    ('key_error', 'key_error', 'key_error.log'),
+    ('empty', 'empty_error', 'empty.log'),
+]
+
+def open_logs():
+    '''The logger of every log of `LOGS`, by log.'''
+    loggers = {}
+    for log, logger_name, filename in LOGS:
+        loggers[log] = logging.getLogger(logger_name)
+        loggers[log].addHandler(logging.FileHandler(filename))
+    return loggers
+
+# columns of the error report
+REPORT_FIELDS = ['patient', 'encdate', 'path', 'keyword', 'message']
+
+def report_file(filepath, f=None):
+    '''Every error of every encounter of one `encounters.json` file.
+
+    Unlike `validate_file` nothing stops at the first error. Returns
+    a list of rows with the `REPORT_FIELDS`, the path is a json path
+    like `$.demographics.parser.dob`. A missing 'file' and an empty
+    file get a row too, with the keyword 'key_error' / 'empty'.
+    `f` is the same as for `validate_file`.
+    '''
+    patient = filepath.split(os.sep)[-2]
+    rows = []
+    validator = checking_validator()
+    count('files')
+    seen = 0
+    with _encounters(filepath, f) as encounters:
+        for item in encounters:
+            seen += 1
+            try:
+                value = item['file']
+            except (KeyError, TypeError) as e:
+                rows.append((patient, None, '$', 'key_error', str(e)))
+                continue
+            encdate = value.get('encdate') if isinstance(value, dict) else None
+            errors = cached(value, lambda: [
+                (e.json_path, e.validator, e.message) for e in validator.iter_errors(value)
+            ], 'report')
+            for path, keyword, message in errors:
+                count(('errors', keyword))
+                rows.append((patient, encdate, path, keyword, message))
+    count('encounters', seen)
+    if not seen:
+        rows.append((patient, None, '$', 'empty', 'no encounters'))
+    return rows
+
+class ReportWriter:
+    '''Write report rows to `f`, `fmt` is 'jsonl' (one object per line) or 'csv'.'''
+
+    def __init__(self, f, fmt='jsonl'):
+        self.f = f
+        self.count = 0
+        self._csv = None
+        if fmt == 'csv':
+            self._csv = csv.writer(f)
+            self._csv.writerow(REPORT_FIELDS)
+        elif fmt != 'jsonl':
+            raise ValueError(f'Unknown report format {fmt!r}')
+
+    def write(self, row):
+        if self._csv is not None:
+            self._csv.writerow(row)
         else:
-            path = 'root'
-        err_text = f"{msg} in {path}"
-        return err_text
+            self.f.write(json.dumps(dict(zip(REPORT_FIELDS, row))) + '\n')
+        self.count += 1
 
 if __name__ == "__main__":
 
-    import json
-    import os
-    import sys
-    import logging
-
-    path = sys.argv[1]
+    import argparse
+    import functools
+    import multiprocessing
 
-    error_logger = logging.getLogger('error')
-    error_handler = logging.FileHandler('error.log')
-    error_logger.addHandler(error_handler)
+    import metrics
 
-    key_error_logger = logging.getLogger('key_error')
-    key_error_handler = logging.FileHandler('key_error.log')
-    key_error_logger.addHandler(key_error_handler)
+    parser = argparse.ArgumentParser(description='Validate every encounters.json under a path')
+    parser.add_argument('path')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes validating files in parallel')
+    parser.add_argument('--format-cache', type=int, default=0, metavar='SIZE',
+                        help='cache up to SIZE format checker verdicts per process, 0 for no cache')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write every error of every encounter to FILE instead of '
+                             'the logs, as csv if FILE ends with .csv else as json lines')
+    parser.add_argument('--manifest', metavar='DB',
+                        help='sqlite file keeping the results of the files between runs, '
+                             'files that didn\'t change since the last run are not validated again')
+    parser.add_argument('--dedup', type=int, default=0, metavar='SIZE',
+                        help='cache the results of up to SIZE encounters per process by doc_hash, '
+                             'so identical encounters are validated once, 0 for no cache')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory map the files and parse them whole without a copy of the text, '
+                             'needs orjson. Faster, but no less memory than reading them whole, '
+                             'see encounter_io.read_encounters')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='time every keyword and format checker, print where the time went and '
+                             'write a collapsed stack file for flamegraphs to FILE. Runs in one process')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    path = args.path
+    if args.profile:
+        profiler = enable_profiling()
+        profiler.wrap_formats(format_checker)
+        args.workers = 1
 
-    empty_error_logger = logging.getLogger('empty_error')
-    empty_error_handler = logging.FileHandler('empty.log')
-    empty_error_logger.addHandler(empty_error_handler)
+    loggers = {}
+    report = None
+    if args.report:
+        check = report_file
+        report_f = open(args.report, 'w', newline='', encoding='utf-8')
+        report = ReportWriter(report_f, 'csv' if args.report.endswith('.csv') else 'jsonl')
+    else:
+        check = validate_file
+        loggers = open_logs()
 
     print(f'Validating path {path}')
-    for root, pat_id, fnames in os.walk(path):
-        for file in fnames:
-            filepath = os.path.join(root, file)
-            if filepath.endswith('encounters.json'):
+    files = list(encounter_files(path))
+    todo = files
+    if args.manifest:
+        from manifest import Manifest, schema_fingerprint, function_source
+        # before the format cache wraps the checkers
+        fingerprint = schema_fingerprint(encounter_schema, format_checker, function_source(check))
+        manifest = Manifest(args.manifest, fingerprint)
+        known, entries = {}, {}
+        for filepath in files:
+            known[filepath], entries[filepath] = manifest.lookup(filepath, check.__name__)
+        todo = [filepath for filepath in files if known[filepath] is None]
+    # with a manifest the workers hash the files they validate
+    run = functools.partial(with_digest if args.manifest else with_counters, check)
+    if args.workers > 1:
+        # every worker builds its validator once at start-up.
+        # `imap` hands the results back in file order and only this
+        # process writes the logs, so lines are never interleaved
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                                    initargs=(args.format_cache, args.dedup, args.mmap))
+        results = pool.imap(run, todo, chunksize=16)
+    else:
+        # build the validator up front, every file reuses it
+        init_worker(args.format_cache, args.dedup, args.mmap)
+        pool = None
+        results = map(run, todo)
+    stats = metrics.Metrics()
+    reporter = metrics.reporter_from_args(stats, args)
+
+    try:
+        stats.gauge('files_pending', len(files))
+        for done, filepath in enumerate(files, 1):
+            if args.manifest and known[filepath] is not None:
+                records = known[filepath]
+            else:
+                result = next(results)
+                if args.manifest:
+                    result, entries[filepath][2] = result
+                records, counts = result
+                stats.merge(counts)
+                if args.manifest:
+                    manifest.store(filepath, check.__name__, entries[filepath], records)
+            # this file is done
+            stats.gauge('files_pending', len(files) - done)
+            print(f"Validating {filepath}")
+            if report is not None:
+                for row in records:
+                    report.write(row)
+                continue
+            for log, message in records:
+                loggers[log].error(message)
+                if log == 'error':
+                    print(f"Validation err in {filepath.split(os.sep)[-2]}")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        stats.merge(take())
+        reporter.stop()
+        if report is not None:
+            report_f.close()
+        if args.manifest:
+            manifest.close()
+            print(f'Manifest: {manifest.hits} files unchanged, {manifest.misses} validated')
 
-                with open(filepath, 'r') as f:
-                    print(f"Validating {filepath}")
-                    encounter_data = json.loads(f.read())
-                    if not encounter_data:
-                        empty_error_logger.error(filepath.split(os.sep)[-2])
-                        continue
-                    for item in encounter_data:
-                        try:
-                            # breakpoint()
-                            value = item['file']
-                        except (KeyError, TypeError) as e:
-                            key_error_logger.error(f"{filepath.split(os.sep)[-2]} - {e}")
-                            break
-                        err = validate_enc(value)
-                        if err:
-                            encdate = value.get('encdate')
-                            error_logger.error(f"{filepath.split(os.sep)[-2]}  - {encdate} -  {err}")
-                            print(f"Validation err in {filepath.split(os.sep)[-2]}")
-                            # breakpoint()
-                            break
-                            
+    if report is not None:
+        print(f'{report.count} errors in {len(files)} files written to {args.report}')
+    if args.dedup:
+        dedup_hits, dedup_misses = stats.counters['dedup_hits'], stats.counters['dedup_misses']
+        print(f'Dedup: {dedup_hits} hits, {dedup_misses} misses, '
+              f'{hit_rate(dedup_hits, dedup_misses):.1%} hit rate')
+    if args.format_cache:
+        cache_hits, cache_misses = stats.counters['format_cache_hits'], stats.counters['format_cache_misses']
+        print(f'Format cache: {cache_hits} hits, {cache_misses} misses, '
+              f'{hit_rate(cache_hits, cache_misses):.1%} hit rate')
+    if args.profile:
+        print(profiler.report())
+        profiler.write_collapsed(args.profile)
+        print(f'Collapsed stacks written to {args.profile}')
@@ -0,0 +1,265 @@
+'''Compile `encounter_schema` into specialised python functions.
+
+The generic jsonschema validator looks up and calls a keyword function
+for every keyword of every node of every encounter. The schema never
+changes, so here we generate one python function per subschema instead,
+with the type, required and format checks written out inline. Leaf
+subschemas (only `type` / `format`) don't even get a call, their checks
+are inlined into the parent.
+
+Only the part of Draft 7 the encounter schema uses is supported:
+type, properties, required, items, anyOf, minItems, additionalProperties,
+default and format. Anything else fails at compile time, so the schema
+can't silently drift away from what the compiler understands.
+
+The generated functions only decide if a node is valid. When a check
+fails the error is built by the keyword function of the generic validator
+(the lazy ones of lazy_errors where there is one, the `anyOf` errors are
+built inline as `LazyError`s too), so the messages, paths
+and `best_match` pick are the same as `validate_enc`.
+
+test_schema_compiler.py checks the compiled validator against the
+generic one over valid and broken synthetic encounters.
+'''
+from functools import lru_cache
+
+from jsonschema import validators
+from jsonschema.exceptions import best_match
+
+from lazy_errors import LazyError, any_of_message, lazy_keywords
+from schema2 import encounter_schema, error_text, format_checker
+
+
+# keywords that don't take part in validation
+IGNORED = {'$schema', 'default', 'title', 'description', '$comment'}
+# keywords that can be inlined into the parent
+LEAF = {'type', 'format'} | IGNORED
+SUPPORTED = LEAF | {
+    'properties', 'required', 'items', 'anyOf', 'minItems', 'additionalProperties',
+}
+
+# json types that are a single `isinstance` / `is` test
+INLINE_TYPES = {
+    'object': 'isinstance({0}, dict)',
+    'array': 'isinstance({0}, list)',
+    'string': 'isinstance({0}, str)',
+    'null': '{0} is None',
+}
+
+
+class CompiledValidator:
+    '''Validator for one schema, built from generated python code.
+
+    `source` has the generated code, handy for debugging.
+    '''
+
+    def __init__(self, schema, format_checker=None):
+        self.schema = schema
+        # the generic validator, only used to build errors
+        cls = validators.validator_for(schema)
+        cls.check_schema(schema)
+        self.generic = lazy_keywords(cls)(schema, format_checker=format_checker)
+
+        compiler = _Compiler(self.generic)
+        root = compiler.function(schema)
+        self.source = '\n\n'.join(compiler.sources)
+        namespace = dict(compiler.constants)
+        namespace.update(
+            _fail=self._fail,
+            _push=_push,
+            _error=LazyError,
+            _any_of_message=any_of_message,
+            _is_type=self.generic.is_type,
+            _conforms=format_checker.conforms if format_checker else None,
+        )
+        exec(compile(self.source, f'<compiled {root}>', 'exec'), namespace)
+        self._root = namespace[root]
+
+    def _fail(self, keyword, instance, schema, path, schema_path):
+        '''Errors of the jsonschema `keyword` function for `instance`.'''
+        value = schema[keyword]
+        errors = []
+        for error in self.generic.VALIDATORS[keyword](self.generic, value, instance, schema):
+            error._set(
+                validator=keyword,
+                validator_value=value,
+                instance=instance,
+                schema=schema,
+                type_checker=self.generic.TYPE_CHECKER,
+            )
+            error.relative_schema_path.extendleft(reversed(schema_path + (keyword,)))
+            error.relative_path.extendleft(reversed(path))
+            errors.append(error)
+        return errors
+
+    def iter_errors(self, instance):
+        return iter(self._root(instance))
+
+    def is_valid(self, instance):
+        return not self._root(instance)
+
+
+def _push(errors, path, schema_path):
+    '''Move `errors` of a child node up to its parent.'''
+    for error in errors:
+        if path is not None:
+            error.relative_path.appendleft(path)
+        error.relative_schema_path.extendleft(reversed(schema_path))
+    return errors
+
+
+class _Compiler:
+
+    def __init__(self, validator):
+        self.validator = validator
+        self.sources = []
+        self.constants = {}
+        self._names = {}
+        self._counter = 0
+
+    def name(self, prefix):
+        self._counter += 1
+        return f'{prefix}{self._counter}'
+
+    def constant(self, value):
+        name = self._names.get(id(value))
+        if name is None:
+            name = self._names[id(value)] = self.name('_k')
+            self.constants[name] = value
+        return name
+
+    def function(self, schema):
+        '''Generate the function validating `schema`, return its name.'''
+        key = ('function', id(schema))
+        if key in self._names:
+            return self._names[key]
+        unknown = set(schema) - SUPPORTED
+        if unknown:
+            raise ValueError(f'Can not compile keywords {sorted(unknown)}')
+        name = self._names[key] = self.name('_s')
+        lines = [f'def {name}(x):', '    errors = []']
+        self.keywords(schema, 'x', '()', (), lines, 1)
+        lines.append('    return errors')
+        self.sources.append('\n'.join(lines))
+        return name
+
+    def keywords(self, schema, var, path, schema_path, lines, depth):
+        '''Emit the checks of every keyword of `schema` against `var`.
+
+        `path` is the code of the path tuple from the function's node
+        to `var`, `schema_path` the matching schema path.
+        '''
+        pad = '    ' * depth
+        s = self.constant(schema)
+
+        def fail(keyword):
+            return f'errors.extend(_fail({keyword!r}, {var}, {s}, {path}, {schema_path!r}))'
+
+        for keyword, value in schema.items():
+            if keyword in IGNORED:
+                continue
+            if keyword == 'type':
+                types = [value] if isinstance(value, str) else value
+                checks = ' or '.join(
+                    INLINE_TYPES[t].format(var) if t in INLINE_TYPES else f'_is_type({var}, {t!r})'
+                    for t in types
+                )
+                lines += [f'{pad}if not ({checks}):', f'{pad}    {fail(keyword)}']
+            elif keyword == 'format':
+                if self.validator.format_checker is None:
+                    continue
+                lines += [f'{pad}if not _conforms({var}, {value!r}):', f'{pad}    {fail(keyword)}']
+            elif keyword == 'required':
+                if not value:
+                    continue
+                checks = ' and '.join(f'{key!r} in {var}' for key in value)
+                lines += [f'{pad}if isinstance({var}, dict) and not ({checks}):', f'{pad}    {fail(keyword)}']
+            elif keyword == 'minItems':
+                lines += [f'{pad}if isinstance({var}, list) and len({var}) < {value!r}:', f'{pad}    {fail(keyword)}']
+            elif keyword == 'properties':
+                lines.append(f'{pad}if isinstance({var}, dict):')
+                if not value:
+                    lines.append(f'{pad}    pass')
+                for key, subschema in value.items():
+                    child = self.name('_v')
+                    lines += [f'{pad}    if {key!r} in {var}:', f'{pad}        {child} = {var}[{key!r}]']
+                    self.descend(subschema, child, repr(key), ('properties', key), lines, depth + 2)
+            elif keyword == 'items':
+                if not isinstance(value, dict):
+                    raise ValueError('Can only compile a single schema for `items`')
+                index, child = self.name('_i'), self.name('_v')
+                lines += [f'{pad}if isinstance({var}, list):', f'{pad}    for {index}, {child} in enumerate({var}):']
+                self.descend(value, child, index, ('items',), lines, depth + 2)
+            elif keyword == 'additionalProperties':
+                if 'patternProperties' in schema:
+                    raise ValueError('Can not compile `patternProperties`')
+                properties = self.constant(set(schema.get('properties', {})))
+                if value is True:
+                    continue
+                if value is False:
+                    lines += [f'{pad}if isinstance({var}, dict) and not {properties}.issuperset({var}):', f'{pad}    {fail(keyword)}']
+                    continue
+                extra, child = self.name('_p'), self.name('_v')
+                lines += [
+                    f'{pad}if isinstance({var}, dict):',
+                    f'{pad}    for {extra}, {child} in {var}.items():',
+                    f'{pad}        if {extra} in {properties}:',
+                    f'{pad}            continue',
+                ]
+                self.descend(value, child, extra, ('additionalProperties',), lines, depth + 2)
+            elif keyword == 'anyOf':
+                # only build the context when every branch failed
+                context = self.name('_c')
+                for index, subschema in enumerate(value):
+                    branch = self.function(subschema)
+                    inner = pad + '    ' * index
+                    lines += [
+                        f'{inner}{context}_e = {branch}({var})',
+                        f'{inner}if {context}_e:',
+                        f'{inner}    {context} = _push({context}_e, None, ({index},))' if index == 0 else
+                        f'{inner}    {context}.extend(_push({context}_e, None, ({index},)))',
+                    ]
+                inner = pad + '    ' * len(value)
+                lines += [
+                    f'{inner}errors.append(_error(',
+                    f'{inner}    _any_of_message, {var},',
+                    f'{inner}    validator="anyOf", validator_value={self.constant(value)}, instance={var},',
+                    f'{inner}    schema={s}, path={path}, schema_path={schema_path + ("anyOf",)!r}, context={context},',
+                    f'{inner}))',
+                ]
+
+    def descend(self, schema, var, key, schema_key, lines, depth):
+        '''Emit the checks of the child node `var`, reached through the code `key`.'''
+        pad = '    ' * depth
+        if set(schema) <= LEAF:
+            # inline the checks, no call for the child
+            size = len(lines)
+            self.keywords(schema, var, f'({key},)', schema_key, lines, depth)
+            if len(lines) == size:
+                lines.append(f'{pad}pass')
+            return
+        function = self.function(schema)
+        errors = self.name('_e')
+        lines += [
+            f'{pad}{errors} = {function}({var})',
+            f'{pad}if {errors}:',
+            f'{pad}    errors.extend(_push({errors}, {key}, {schema_key!r}))',
+        ]
+
+
+def compile_schema(schema, format_checker=None):
+    return CompiledValidator(schema, format_checker=format_checker)
+
+
+@lru_cache(maxsize=None)
+def compiled_encounter_validator():
+    '''Return the compiled validator for the encounter schema, built once per process.'''
+    return compile_schema(encounter_schema, format_checker=format_checker)
+
+
+def validate_enc(enc):
+    '''Same as `schema2.validate_enc` but with the compiled validator.'''
+    e = best_match(compiled_encounter_validator().iter_errors(enc))
+    if e is not None:
+        return error_text(e)
+
@@ -0,0 +1,81 @@
+'''`iter_encounters` against `json.loads`, read in small chunks with every json backend.'''
+import io
+import json
+
+import pytest
+
+import encounter_io
+import json_backend
+from encounter_io import iter_encounters
+
+CHUNK_SIZES = [1, 2, 3, 7, 64]
+
+ITEMS = [
+    {'a': 1, 'b': [1, 2]},
+    'a]b,c',
+    '],[',
+    'x\\"]',
+    12345678901234567890,
+    -2.5e10,
+    0.125,
+    0,
+    None,
+    True,
+    [],
+    {},
+    {'é]': ['東京', ',']},
+]
+
+SEPARATORS = [',', ', ', ' ,', '\n,\n', ' \t, ']
+
+VALID = [
+    '[]',
+    ' [ ] ',
+    '\n\n[\n]\n',
+    '[1]',
+    '[12345,6789]',
+    '[-1.5e-7 ,1E+3]',
+    '[[[]],{}]',
+    ' \n  [{"a": [1, 2]}, "x"]  \n',
+] + [
+    start + '[' + inner + separator.join(json.dumps(item, ensure_ascii=False) for item in ITEMS) + inner + ']' + end
+    for separator in SEPARATORS
+    for start, inner, end in [('', '', ''), (' ', ' ', ' '), ('\n', '\n', '\n\n')]
+]
+
+# what isn't an array is read whole, like `json.load`
+NOT_ARRAYS = ['{"a": 1, "b": 2}', ' null ', '0', '""']
+
+BROKEN = ['', ' \n', '[', '[1', '[1,', '[1,]', '[,1]', '[1 2]', '[1,,2]', '[1] x', '[1]]', '[1] [2]', '["a]', '[1}']
+
+
+@pytest.fixture(params=json_backend.available())
+def backend(request):
+    previous = json_backend.backend
+    json_backend.set_backend(request.param)
+    yield request.param
+    json_backend.set_backend(previous)
+
+
+@pytest.fixture(params=['whole', 'streamed'])
+def whole_file_size(request, monkeypatch):
+    # with orjson only the files of at least `WHOLE_FILE_SIZE` characters are streamed
+    if request.param == 'streamed':
+        monkeypatch.setattr(encounter_io, 'WHOLE_FILE_SIZE', 1)
+    return encounter_io.WHOLE_FILE_SIZE
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('text', VALID + NOT_ARRAYS)
+def test_same_as_json(text, chunk_size, backend, whole_file_size):
+    expected = json.loads(text)
+    assert list(iter_encounters(io.StringIO(text), chunk_size)) == list(expected or [])
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('text', BROKEN)
+def test_broken(text, chunk_size, backend, whole_file_size):
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(text)
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_encounters(io.StringIO(text), chunk_size))
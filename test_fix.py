@@ -0,0 +1,56 @@
+'''`fix.repair` against the `iter_errors` + `validate` run fix.py used to do.'''
+import copy
+import random
+
+import pytest
+from jsonschema.exceptions import ValidationError
+
+import fix
+from encounter_gen import make_encounters, make_mixed_encounters
+from schema2 import encounter_schema, format_checker
+
+# the `$schema` of encounter_schema is unknown to jsonschema, which warns on every call
+pytestmark = pytest.mark.filterwarnings('ignore::DeprecationWarning')
+
+
+def encounters():
+    encounters = make_mixed_encounters(300, error_rate=0.6, seed=6)
+    rng = random.Random(7)
+    # whole parts missing, their defaults and required keys get filled in
+    for enc in make_encounters(100, seed=9000):
+        for key in rng.sample(sorted(enc), 2):
+            del enc[key]
+        encounters.append(enc)
+    return encounters
+
+
+def outcome(func, enc):
+    # the repaired document, or the error the repair code crashed with, it still has some holes
+    try:
+        return func(enc)
+    except Exception as e:
+        return type(e)
+
+
+def two_passes(enc):
+    v = fix.DefaultValidatingDraft7Validator(schema=encounter_schema, format_checker=format_checker)
+    list(v.iter_errors(enc))
+    try:
+        v.validate(enc)
+    except ValidationError:
+        pass
+    return enc
+
+
+def single_pass(enc):
+    return fix.repair(enc)[0]
+
+
+@pytest.mark.parametrize('precheck', [True, False])
+def test_repair_same_as_two_passes(precheck, monkeypatch):
+    monkeypatch.setattr(fix, 'PRECHECK', precheck)
+    mismatches = [
+        i for i, enc in enumerate(encounters())
+        if outcome(two_passes, copy.deepcopy(enc)) != outcome(single_pass, copy.deepcopy(enc))
+    ]
+    assert mismatches == []
@@ -0,0 +1,111 @@
+'''The format checkers against the ones of before, they must give the same verdicts.'''
+import random
+import re
+from datetime import datetime
+
+import schema2
+
+
+# the format checkers as they were before they got precompiled patterns
+def old_normal_date(value):
+    if value == None:
+        return True
+    if value == 'None':
+        return True
+    if value == schema2.PLACE_HOLDER:
+        return True
+    return old_normal_dob(value)
+
+
+def old_normal_dob(value):
+    try:
+        datetime.strptime(value, '%m/%d/%Y')
+    except Exception:
+        return False
+    return True
+
+
+def old_normal_phone_number(value):
+    if value is None:
+        return False
+    if value == schema2.PLACE_HOLDER:
+        return True
+    value = value.strip()
+    if len(value) < 5:
+        return False
+    if value.startswith('-'):
+        return False
+    if value.endswith('-'):
+        return False
+    if value == '(000)000-0000':
+        return False
+    non_number = set(x.strip() for x in re.findall(r'\D', value) if x.strip())
+    non_number = set(x for x in non_number if x not in schema2.ACCEPTED_PHONE_STRS)
+    if len(non_number) != 0:
+        return False
+    return True
+
+
+def old_normal_name(value):
+    if not schema2.non_empty_string(value):
+        return False
+    if not value.count(" ") < 6:
+        return False
+    return bool(re.match(r'^[ a-zA-Z\.\-\,\']{1,150}$', value))
+
+
+FORMATS = [
+    ('normal_date', old_normal_date, schema2.normal_date),
+    ('normal_dob', old_normal_dob, schema2.normal_dob),
+    ('normal_phone_number', old_normal_phone_number, schema2.normal_phone_number),
+    ('normal_name', old_normal_name, schema2.normal_name),
+]
+
+# characters the random values are made of, the odd ones are there
+# because the old checkers treat unicode digits and whitespaces specially
+FORMAT_ALPHABET = '0123456789//--()+ .,\'aZ\n\t\xa0\u0663\u06f1\uff11x'
+FORMAT_SAMPLES = [
+    None, '', 'None', 'No data found', 12, '01/31/2020', '1/1/2020', '02/29/2020', '02/29/2100',
+    '02/29/2000', '2/30/2020', '01/ 2/2020', '00/01/2020', '1/1/0000', '13/01/2020', '1/1/2020\n',
+    '(217) 555-0134', '217-555-0134', '+1 217 555 0134', '(000)000-0000', '555-0134-', 'ext 123',
+    "O'Brien, Mary-Jane", 'John  Smith', 'J0hn',
+]
+
+
+def random_value(rng):
+    '''A value for the property check, near misses of the formats most of the time.'''
+    kind = rng.random()
+    if kind < 0.3:
+        # a date with random parts
+        parts = [''.join(rng.choice('0123456789 \u0663') for _ in range(rng.randint(0, 5))) for _ in range(3)]
+        return '/'.join(parts)
+    if kind < 0.4:
+        return rng.choice(FORMAT_SAMPLES)
+    if kind < 0.5:
+        # mangle a known value
+        value = list(rng.choice([v for v in FORMAT_SAMPLES if isinstance(v, str)]) or 'x')
+        value[rng.randrange(len(value))] = rng.choice(FORMAT_ALPHABET)
+        return ''.join(value)
+    return ''.join(rng.choice(FORMAT_ALPHABET) for _ in range(rng.randint(0, 16)))
+
+
+COUNT = 20000
+
+
+def test_same_verdicts():
+    rng = random.Random(0)
+    values = FORMAT_SAMPLES + [random_value(rng) for _ in range(COUNT)]
+    mismatches = []
+    for name, old, new in FORMATS:
+        for value in values:
+            try:
+                expected = old(value)
+            except Exception as e:
+                expected = type(e)
+            try:
+                got = new(value)
+            except Exception as e:
+                got = type(e)
+            if expected != got:
+                mismatches.append((name, value, expected, got))
+    assert mismatches == []
@@ -0,0 +1,45 @@
+'''The patches of `fix-iter.py --patch` applied against the files fix-iter.py writes.'''
+import importlib
+
+import pytest
+
+import json_backend
+from encounter_gen import make_dump
+from json_patch import patched_text
+
+fix_iter = importlib.import_module('fix-iter')
+
+# the `$schema` of encounter_schema is unknown to jsonschema, which warns on every call
+pytestmark = pytest.mark.filterwarnings('ignore::DeprecationWarning')
+
+
+def outcome(func, *args):
+    # the repair code crashes on some broken encounters, the same way with and without `patch`
+    try:
+        return func(*args)
+    except Exception as e:
+        return type(e)
+
+
+def repaired(path):
+    return fix_iter.repair_file(path, True).text
+
+
+def patch_ops(path):
+    patch = fix_iter.repair_file(path, True, patch=True).text
+    return json_backend.loads(patch) if patch else []
+
+
+def patched(path):
+    return patched_text(path, patch_ops(path))
+
+
+@pytest.mark.parametrize('precheck', [True, False])
+def test_patch_gives_repaired_file(precheck, monkeypatch, tmp_path):
+    monkeypatch.setattr(fix_iter, '_precheck', precheck)
+    files = make_dump(tmp_path, 40, per_patient=4, seed=23, error_rate=0.3)
+    mismatches = [path for path in files if outcome(repaired, path) != outcome(patched, path)]
+    assert mismatches == []
+    # some files do get a patch
+    patches = [outcome(patch_ops, path) for path in files]
+    assert any(isinstance(ops, list) and ops for ops in patches)
@@ -0,0 +1,70 @@
+'''The compiled validator against the generic one, over synthetic encounters.'''
+import random
+
+import pytest
+from jsonschema import validators
+from jsonschema.exceptions import best_match
+
+import schema2
+from encounter_gen import break_encounter, make_encounters
+from schema_compiler import CompiledValidator, compiled_encounter_validator
+
+COUNT = 300
+
+# the `$schema` of encounter_schema is unknown to jsonschema, which warns on every call
+pytestmark = pytest.mark.filterwarnings('ignore::DeprecationWarning')
+
+
+def encounters():
+    rng = random.Random(0)
+    valid = make_encounters(COUNT)
+    broken = [break_encounter(enc, rng, rng.randint(1, 5)) for enc in make_encounters(COUNT, seed=COUNT)]
+    # longer lists, more errors in list items and in the `anyOf` of their dates
+    broken += [break_encounter(enc, rng, 8) for enc in make_encounters(COUNT, seed=2 * COUNT, list_size=4)]
+    return valid + broken
+
+
+def error_keys(errors):
+    '''Everything about `errors` and their `context`, in a comparable order.'''
+    return sorted(
+        (list(e.absolute_path), list(e.absolute_schema_path), e.validator, e.message, error_keys(e.context))
+        for e in errors
+    )
+
+
+def best(errors):
+    e = best_match(errors)
+    if e is not None:
+        return list(e.absolute_path), list(e.absolute_schema_path), e.validator, schema2.error_text(e)
+
+
+@pytest.fixture(scope='module')
+def checkers():
+    plain = validators.validator_for(schema2.encounter_schema)(
+        schema2.encounter_schema, format_checker=schema2.format_checker)
+    return compiled_encounter_validator(), schema2.encounter_validator(), plain
+
+
+def test_same_errors(checkers):
+    compiled, *generic = checkers
+    mismatches = [
+        i for i, enc in enumerate(encounters())
+        if any(error_keys(compiled.iter_errors(enc)) != error_keys(v.iter_errors(enc)) for v in generic)
+    ]
+    assert mismatches == []
+
+
+def test_same_best_match(checkers):
+    compiled, *generic = checkers
+    mismatches = [
+        i for i, enc in enumerate(encounters())
+        if any(best(compiled.iter_errors(enc)) != best(v.iter_errors(enc)) for v in generic)
+    ]
+    assert mismatches == []
+
+
+def test_validate_enc_uses_compiled():
+    enc = make_encounters(1)[0]
+    enc['ehr_id'] = None
+    assert isinstance(schema2.checking_validator(), CompiledValidator)
+    assert schema2.validate_enc(enc) == schema2.error_text(best_match(schema2.encounter_validator().iter_errors(enc)))